@@ -16,7 +16,15 @@ Key Features:
 
 import pymmcore_plus
 import os
+import time
 import ctypes
+import json
+from tracking_plan import compile_plan
+from frame_source import FrameStats
+from stage_model import StageModel
+from calibration_cache import CalibrationCache, CALIBRATION_KEYS
+from frame_publisher import FramePublisher
+from event_log import EventLog
 
 
 # Set the correct Micro-Manager path before creating CMMCore()
@@ -29,8 +37,10 @@ class CameraManager:
     Manages one or two Micro-Manager camera cores (primary and optional secondary).
     Loads configuration files, applies camera-specific settings, and handles cleanup.
     """
-    def __init__(self, primary_config=None, secondary_config=None):
+    def __init__(self, primary_config=None, secondary_config=None, primary_core=None):
         print("Initializing Camera Manager")
+        # structured session log used by the live loops instead of printing, see event_log
+        self.events = EventLog(self.get_session_dir)
         # create timer instances for the live and recording commands
         self.img_width = None
         self.img_height = None
@@ -40,6 +50,23 @@ class CameraManager:
         self.last_recording_frame_time = None
         self.last_position = None
         self.current_position = None
+        self.detection = None
+        self.session_dir = None
+        self.session_log = None
+        self.posture_worker = None
+        self.mosaic = None
+        self.multi_tracker = None
+        self.roi_recorder = None
+        self.focus_tracker = None
+        self.replay = None
+        self.mda_recorder = None
+        self.stage = None
+        self.primary_config = primary_config
+        self.calibration_status = "default"
+        self.publisher = None
+        # frame counts of each core, see frame_source.pop_frames
+        self.tracking_stats = FrameStats("tracking")
+        self.recording_stats = FrameStats("recording")
         self.tracking_state = {"prepare": "OFF",
                                "track": "OFF",
                                "record": "OFF"}
@@ -60,39 +87,74 @@ class CameraManager:
             "dilate": 1,
             "max_runway": 10000,
             "brightfield": True,
-            "Save_stage_positions": False
+            "Save_stage_positions": False,
+            "posture_every_n": 0,
+            "posture_points": 50,
+            "mosaic_every_n": 5,
+            "mosaic_um_per_pixel": 20,
+            "multi_worm": False,
+            "min_blob_area": 50,
+            "multi_worm_max_distance_um": 60,
+            "frame_policy": "latest",
+            "every_n_frames": 2,
+            "autofocus": False,
+            "af_every_n": 5,
+            "af_step": 2.0,
+            "replay_frames": 200,
+            "stage_resync_s": 1.0,
+            "stage_motion": False,
+            "publish_frames": False,
+            "shared_memory_name": "worm_tracker_live"
         }
 
+        # the per-frame pipeline compiled from tracking_tab_settings, see update_tracking_settings
+        self.plan = compile_plan(self.tracking_tab_settings)
+        # restored when there is no cached calibration, so a matrix measured at another binning is not kept
+        self.default_calibration = {key: self.tracking_tab_settings[key] for key in CALIBRATION_KEYS}
+
         self.recording_tab_settings = {
             "exposure": 10,
             "fps": 20,
             "binning": "2x2",
-            "Save_stage_positions": False
+            "Save_stage_positions": False,
+            "mda_duration_s": 60
         }
 
-        # Ensure primary_config is provided
-        if primary_config is None:
-            raise ValueError("Error: primary_config cannot be None.")
-        if not os.path.isfile(primary_config):
-            raise FileNotFoundError(f"Primary configuration file not found: {primary_config}")
-
-        try:
-            print("Initializing tracking core")
-            self.primary_core = pymmcore_plus.CMMCorePlus()
-            print("Tracking core created")
-            self.primary_core.loadSystemConfiguration(primary_config)
-            print("Primary configuration loaded successfully.")
-
-            self.primary_camera = self.primary_core.getCameraDevice()
-            if self.primary_camera:
-                self._setup_camera(self.primary_core, self.primary_camera)
-            else:
-                print("Warning: No primary camera detected!")
-        except Exception as e:
-            error_msg = self.primary_core.getLastError() if hasattr(self, "primary_core") else "Micro-Manager core failed before initialization."
-            print(f"Micro-Manager Error: {error_msg}")
-            print(f"Error loading primary configuration: {str(e)}")
-            raise
+        if primary_core is not None:
+            # an already loaded core, e.g. the simulated rig of closed_loop_benchmark
+            self.primary_core = primary_core
+            self.primary_camera = primary_core.getCameraDevice()
+            self.stage = StageModel(self.primary_core, self.tracking_tab_settings["stage_resync_s"])
+        else:
+            # Ensure primary_config is provided
+            if primary_config is None:
+                raise ValueError("Error: primary_config cannot be None.")
+            if not os.path.isfile(primary_config):
+                raise FileNotFoundError(f"Primary configuration file not found: {primary_config}")
+
+            try:
+                print("Initializing tracking core")
+                self.primary_core = pymmcore_plus.CMMCorePlus()
+                print("Tracking core created")
+                self.primary_core.loadSystemConfiguration(primary_config)
+                print("Primary configuration loaded successfully.")
+
+                self.primary_camera = self.primary_core.getCameraDevice()
+                if self.primary_camera:
+                    self._setup_camera(self.primary_core, self.primary_camera)
+                else:
+                    print("Warning: No primary camera detected!")
+                # stage position estimated from the commanded moves, see stage_model
+                self.stage = StageModel(self.primary_core, self.tracking_tab_settings["stage_resync_s"])
+            except Exception as e:
+                error_msg = self.primary_core.getLastError() if hasattr(self, "primary_core") else "Micro-Manager core failed before initialization."
+                print(f"Micro-Manager Error: {error_msg}")
+                print(f"Error loading primary configuration: {str(e)}")
+                raise
+
+        # reuse the calibration of this camera, binning and configuration from an earlier session
+        if self.primary_config is not None:
+            self.load_calibration()
 
         # Load secondary camera if a path was selected
         self.secondary_core = None
@@ -134,3 +196,127 @@ class CameraManager:
             elif core.hasProperty(camera, "Triggermode"):
                 core.setProperty(camera, "Triggermode", "External")
 
+    def update_tracking_settings(self, changes):
+        """
+        Updates tracking_tab_settings and rebuilds the tracking plan. The new plan is compiled
+        before anything is changed and then swapped in with a single assignment, so the tracking
+        loop never sees a half-updated configuration.
+        """
+        settings = dict(self.tracking_tab_settings)
+        settings.update(changes)
+        plan = compile_plan(settings)
+        self.tracking_tab_settings.update(changes)
+        self.plan = plan
+        if "stage_resync_s" in changes and self.stage is not None:
+            self.stage.resync_s = self.tracking_tab_settings["stage_resync_s"]
+        # the calibration depends on the binning
+        if "binning" in changes and self.primary_config is not None:
+            self.load_calibration()
+
+    def load_calibration(self):
+        """Applies the cached calibration for the tracking camera and binning, if there is one."""
+        values, stale = CalibrationCache().lookup(self.primary_camera, self.tracking_tab_settings["binning"],
+                                                  self.primary_config)
+        if values is None:
+            self.update_tracking_settings(self.default_calibration)
+            self.calibration_status = "default"
+            print("No cached calibration for this camera and binning, using the default calibration, please calibrate.")
+            return
+        self.update_tracking_settings(values)
+        if stale:
+            self.calibration_status = "stale"
+            print("Warning: the configuration file changed since the cached calibration was measured, "
+                  "please recalibrate.")
+        else:
+            self.calibration_status = "cached"
+            print("Loaded cached calibration.")
+
+    def save_tracking_settings(self, path):
+        """Saves tracking_tab_settings as JSON, e.g. as the starting point of parameter_sweep."""
+        with open(path, "w") as f:
+            json.dump(self.tracking_tab_settings, f, indent=2)
+        print(f"Saved tracking settings to {path}")
+
+    def load_tracking_settings(self, path):
+        """
+        Applies tracking settings saved as JSON (by save_tracking_settings or parameter_sweep)
+        through update_tracking_settings. The calibration is measured per rig and binning and
+        comes from the calibration cache, so it is not taken from the file; keys this version
+        does not know are ignored. Returns the settings that were applied.
+        """
+        with open(path) as f:
+            loaded = json.load(f)
+        changes = {key: value for key, value in loaded.items()
+                   if key in self.tracking_tab_settings and key not in CALIBRATION_KEYS}
+        self.update_tracking_settings(changes)
+        print(f"Loaded {len(changes)} tracking settings from {path}")
+        return changes
+
+    def save_calibration(self):
+        """Saves the current calibration for the tracking camera and binning."""
+        CalibrationCache().store(self.primary_camera, self.tracking_tab_settings["binning"],
+                                 self.primary_config, self.tracking_tab_settings)
+        self.calibration_status = "cached"
+
+    def open_events(self):
+        """Starts a new event log writer when the previous one was closed with the last live."""
+        if not self.events.thread.is_alive():
+            self.events = EventLog(self.get_session_dir)
+
+    def get_session_dir(self):
+        """Returns the folder where files of the current session are saved, creating it on first use."""
+        if self.session_dir is None:
+            self.session_dir = os.path.join(os.getcwd(), "sessions", time.strftime("%Y%m%d_%H%M%S"))
+            os.makedirs(self.session_dir, exist_ok=True)
+        return self.session_dir
+
+    def open_publisher(self, frame_shape, dtype):
+        """Starts publishing the live tracking frames to shared memory for other programs, see frame_publisher."""
+        self.close_publisher()
+        if self.tracking_tab_settings["publish_frames"]:
+            try:
+                self.publisher = FramePublisher(frame_shape, dtype, name=self.tracking_tab_settings["shared_memory_name"])
+            except FileExistsError as e:
+                print(f"Not publishing frames: {e}")
+
+    def close_publisher(self):
+        if self.publisher is not None:
+            self.publisher.close()
+            self.publisher = None
+
+    def close_roi_recording(self):
+        if self.roi_recorder is not None:
+            self.roi_recorder.close()
+            self.roi_recorder = None
+
+    def close_session_files(self):
+        """Closes the stage position log, posture file, worm tracks and ROI recording so they can be analyzed offline."""
+        self.close_roi_recording()
+        if self.session_log is not None:
+            self.session_log.close()
+            print(f"Saved {self.session_log.rows} stage positions to {self.session_log.path}")
+            self.session_log = None
+        if self.posture_worker is not None:
+            self.posture_worker.stop()
+            self.posture_worker = None
+        if self.multi_tracker is not None and self.multi_tracker.rows:
+            self.multi_tracker.save(os.path.join(self.get_session_dir(), "multi_worm_tracks.csv"))
+        self.events.flush()
+        self.save_frame_stats()
+
+    def save_frame_stats(self):
+        """Saves the frame counts of the session, so undersampled sessions can be flagged afterwards."""
+        if self.session_dir is None:
+            return
+        stats = [self.tracking_stats.summary()]
+        if self.secondary_core:
+            stats.append(self.recording_stats.summary())
+        with open(os.path.join(self.session_dir, "frame_stats.json"), "w") as f:
+            json.dump(stats, f, indent=2)
+        if self.stage is not None:
+            with open(os.path.join(self.session_dir, "stage_drift.json"), "w") as f:
+                json.dump(self.stage.summary(), f, indent=2)
+        for core_stats in stats:
+            if core_stats["undersampled"]:
+                print(f"Warning: {core_stats['name']} camera was undersampled, "
+                      f"{100 * core_stats['drop_fraction']:.1f}% of frames dropped.")
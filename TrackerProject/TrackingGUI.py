@@ -81,12 +81,14 @@ class CameraGUI(QMainWindow):
         self.xy_stage_name_label          = QLabel("XY-stage name: (none)")
         self.recording_camera_name_label  = QLabel("Recording camera name: (not loaded)")
         self.recording_camera_light_label = QLabel("Recording camera light source: (none)")
+        self.calibration_label            = QLabel("Calibration: (not loaded)")
 
         layout.addWidget(self.tracking_camera_name_label,   3, 0, 1, 3)
         layout.addWidget(self.tracking_light_source_label,  4, 0, 1, 3)
         layout.addWidget(self.xy_stage_name_label,          5, 0, 1, 3)
         layout.addWidget(self.recording_camera_name_label,  6, 0, 1, 3)
         layout.addWidget(self.recording_camera_light_label, 7, 0, 1, 3)
+        layout.addWidget(self.calibration_label,            8, 0, 1, 3)
 
     def setup_recording_camera_tab(self):
         layout = QGridLayout()
@@ -141,6 +143,7 @@ class CameraGUI(QMainWindow):
 
         # Update existing tracking tab instead of creating a new one
         self.tracking_camera_tab.set_camera_manager(self.camera_manager)
+        self.tracking_camera_tab.calibration_changed.connect(self.update_calibration_label)
         # Update labels for devices
         self.update_device_labels()
 
@@ -182,6 +185,12 @@ class CameraGUI(QMainWindow):
         else:
             self.recording_camera_light_label.setText("Recording camera light source: (none)")
 
+        # 6) Whether the calibration was loaded from the cache
+        self.update_calibration_label()
+
+    def update_calibration_label(self):
+        self.calibration_label.setText(f"Calibration: {self.camera_manager.calibration_status}")
+
 def main():
     app = QApplication(sys.argv)
     window = CameraGUI()
@@ -0,0 +1,150 @@
+"""
+FocusTracker: Keeping the worm in focus by hill-climbing on ROI sharpness
+
+Worms crawl out of focus on uneven plates. Every Nth frame the sharpness of the tracking ROI
+(the square_size window around the worm) is measured with a cheap metric, and a hill-climbing
+controller nudges the focus drive: it keeps stepping in the same direction while the image gets
+sharper, and reverses and halves its step when it gets blurrier, down to a minimum step with
+which it keeps dithering around the best focus.
+
+Z moves are sent from a separate thread (ZMover), so a slow focus drive never blocks frame
+processing. Frames that may have been exposed while a move was in progress are not used to
+judge that move.
+
+Run this file to try the controller with the pymmcore-plus demo configuration:
+    python autofocus.py
+
+"""
+
+import queue
+import threading
+import time
+import numpy as np
+import cv2
+
+
+def sharpness(image, metric="laplacian"):
+    """Variance of the Laplacian, or gradient energy (mean squared Sobel gradient)."""
+    image = np.asarray(image, dtype=np.float32)
+    if metric == "laplacian":
+        return float(cv2.Laplacian(image, cv2.CV_32F).var())
+    gx = cv2.Sobel(image, cv2.CV_32F, 1, 0)
+    gy = cv2.Sobel(image, cv2.CV_32F, 0, 1)
+    return float(np.mean(gx * gx + gy * gy))
+
+
+class HillClimbFocus:
+    def __init__(self, step=2.0, min_step=0.5, max_step=10.0, tolerance=0.02):
+        self.step = step          # um
+        self.min_step = min_step
+        self.max_step = max_step
+        self.tolerance = tolerance  # relative drop in sharpness that counts as getting worse
+        self.direction = 1
+        self.last_sharpness = None
+
+    def update(self, value):
+        """Returns the relative Z move (um) to make after measuring a sharpness of value."""
+        if self.last_sharpness is not None:
+            if value < self.last_sharpness * (1 - self.tolerance):
+                # we went past the peak: turn around with a smaller step
+                self.direction = -self.direction
+                self.step = max(self.min_step, self.step / 2)
+            elif value > self.last_sharpness * (1 + self.tolerance):
+                # still climbing: speed up a little
+                self.step = min(self.max_step, self.step * 1.5)
+        self.last_sharpness = value
+        return self.direction * self.step
+
+    def reset(self):
+        self.last_sharpness = None
+
+
+class ZMover:
+    """Sends relative focus moves to the core from a background thread, one at a time."""
+    def __init__(self, core, focus_device=None):
+        self.core = core
+        self.focus_device = focus_device or core.getFocusDevice()
+        if not self.focus_device:
+            raise ValueError("Error: no focus device is loaded in the configuration.")
+        self.moves = queue.Queue(maxsize=1)
+        self.busy = False
+        self.completed_at = 0.0
+        self.thread = threading.Thread(target=self._run, name="ZMover", daemon=True)
+        self.thread.start()
+
+    def submit(self, dz):
+        """Queues a move unless one is already in progress. Returns True if it was queued."""
+        if self.busy:
+            return False
+        self.busy = True
+        self.moves.put(dz)
+        return True
+
+    def _run(self):
+        while True:
+            dz = self.moves.get()
+            if dz is None:
+                break
+            try:
+                self.core.setRelativePosition(self.focus_device, dz)
+                self.core.waitForDevice(self.focus_device)
+            except Exception as e:
+                print(f"Focus movement failed: {e}")
+            self.completed_at = time.time()
+            self.busy = False
+
+    def stop(self):
+        self.moves.put(None)
+        self.thread.join()
+
+
+class FocusTracker:
+    def __init__(self, core, every_n=5, step=2.0, metric="laplacian", focus_device=None):
+        self.every_n = max(1, every_n)
+        self.metric = metric
+        self.controller = HillClimbFocus(step=step)
+        self.mover = ZMover(core, focus_device)
+        self.last_sharpness = None
+        self.seen_completion = 0.0
+        self.settle_until = 0
+
+    def process(self, frame, position, square_size, seq):
+        """Called from the tracking loop; measures the ROI and may queue a Z move."""
+        if self.mover.busy:
+            return
+        # frames already in the pipeline when the last move finished may have been exposed during
+        # the move, so the next measurement waits for a frame at least every_n frames later
+        if self.mover.completed_at > self.seen_completion:
+            self.seen_completion = self.mover.completed_at
+            self.settle_until = seq + self.every_n
+        if seq < self.settle_until or seq % self.every_n != 0 or position is None:
+            return
+        x0, y0 = max(0, position[0] - square_size), max(0, position[1] - square_size)
+        roi = frame[y0:position[1] + square_size, x0:position[0] + square_size]
+        self.last_sharpness = sharpness(roi, self.metric)
+        self.mover.submit(self.controller.update(self.last_sharpness))
+
+    def stop(self):
+        self.mover.stop()
+
+
+def demo(frames=100):
+    """Runs the focus tracker on the pymmcore-plus demo configuration, using the whole frame as ROI."""
+    import pymmcore_plus
+    core = pymmcore_plus.CMMCorePlus()
+    core.loadSystemConfiguration()  # demo configuration
+    tracker = FocusTracker(core, every_n=1)
+    start_z = core.getPosition()
+    for seq in range(frames):
+        core.snapImage()
+        frame = core.getImage()
+        height, width = frame.shape
+        tracker.process(frame, (width // 2, height // 2), max(width, height), seq)
+        time.sleep(0.02)
+        print(f"frame {seq}: Z = {core.getPosition():.2f} um, sharpness = {tracker.last_sharpness}")
+    tracker.stop()
+    print(f"Z moved from {start_z:.2f} to {core.getPosition():.2f} um")
+
+
+if __name__ == "__main__":
+    demo()
@@ -1,42 +1,45 @@
 import sys
 import time
+from typing import NamedTuple
 import numpy as np
 from MovingAvg import MovingAvg
+from frame_source import pop_frames, FrameStats
 import cv2
 
 
-def binary_threshold(camera_manager, frame):
-    tracking_tab_settings = camera_manager.tracking_tab_settings
-    threshold = tracking_tab_settings["threshold"]
-    square_size = tracking_tab_settings["square_size"]
-    bright_bkg = tracking_tab_settings["brightfield"]
-    erode_iter = tracking_tab_settings["erode"]
-    dilate_iter = tracking_tab_settings["dilate"]
-    current_position = None
-
-    # define the type of binary threshold based on the type of imaging
-    if bright_bkg:
-        threshold_type = cv2.THRESH_BINARY_INV
-    else:
-        threshold_type = cv2.THRESH_BINARY
-
+"""
+Binarizes a frame so that the worm is white on a black background, using a TrackingPlan
+compiled from tracking_tab_settings (see tracking_plan.py).
+"""
+def binarize_frame(plan, frame):
     # convert to grayscale if the frame is in RGB. this is necessary to binarize
     if len(frame.shape) > 2:
         frame = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
 
-    # binarize image and find the biggest "contours" i.e. the worm in the image
-    _, binary_frame = cv2.threshold(frame, threshold, 255, threshold_type)
-
-    # create a kernel (small matrix) that will be used to scan image and erode or dilate white objects
-    # bigger kernels allows the transformation to be more dramatic
-    kernel = np.ones((3, 3), np.uint8)  # Define a 3x3 kernel for morphology operation
-    # Apply erosion
-    if erode_iter > 0:
-        binary_frame = cv2.erode(binary_frame, kernel, iterations=erode_iter)
-    # Apply dilation
-    if dilate_iter > 0:
-        binary_frame = cv2.dilate(binary_frame, kernel, iterations=dilate_iter)
+    _, binary_frame = cv2.threshold(frame, plan.threshold, 255, plan.threshold_type)
+
+    # erode and dilate with the plan's kernel; matching iterations are done as a single opening
+    for operation, iterations in plan.morphology:
+        cv2.morphologyEx(binary_frame, operation, plan.kernel, dst=binary_frame, iterations=iterations)
+    return binary_frame
+
+"""
+The worm found in a frame: the center of its bounding box (x, y), the square ROI around it
+(x1, y1, x2, y2) and its outline as an (N, 2) array of (x, y) points. Nothing is drawn into the
+binary frame, so the mask can be reused as it is; the GUI draws detections as napari layers
+(see tracking_overlay.py).
+"""
+class Detection(NamedTuple):
+    center: tuple
+    roi: tuple
+    contour: np.ndarray
 
+def detect_worm(plan, frame):
+    square_size = plan.square_size
+    detection = None
+
+    # binarize image and find the biggest "contours" i.e. the worm in the image
+    binary_frame = binarize_frame(plan, frame)
     contours, _ = cv2.findContours(binary_frame, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
 
     if contours:
@@ -48,14 +51,32 @@ def binary_threshold(camera_manager, frame):
         x1, y1 = max(0, cx - square_size), max(0, cy - square_size)
         x2, y2 = min(frame.shape[1], cx + square_size), min(frame.shape[0], cy + square_size)
 
-        # Update position tracking
-        current_position = (cx, cy)
+        detection = Detection(center=(cx, cy), roi=(x1, y1, x2, y2), contour=largest_contour.reshape(-1, 2))
 
-        # Draw rectangle around detected object
-        cv2.rectangle(binary_frame, (x1, y1), (x2, y2), 255, 2)
-        cv2.circle(binary_frame, (cx, cy), 5, 255, -1)  # Mark the center
+    return binary_frame, detection
 
-    return binary_frame, current_position
+def binary_threshold(plan, frame):
+    """Returns the binary frame and the worm center, for callers that only need the position."""
+    binary_frame, detection = detect_worm(plan, frame)
+    return binary_frame, detection.center if detection is not None else None
+
+"""
+Returns the worm center in the newest frame of the tracking camera. Older frames in the buffer
+were taken before the last stage move, so they are dropped, and the frame is reshaped and
+normalized exactly as in the live loop, which the threshold is tuned for.
+"""
+def _newest_position(camera_manager):
+    # imported here because img_handling_functions imports this module
+    from img_handling_functions import normalize_to_8bit
+    core = camera_manager.primary_core
+    while core.getRemainingImageCount() == 0:
+        time.sleep(0.01)
+    frames = pop_frames(core, FrameStats("calibration"), "latest")
+    if not frames or frames[-1][0] is None or frames[-1][0].size == 0:
+        return None
+    img = frames[-1][0].reshape((core.getImageHeight(), core.getImageWidth()))
+    _, position = binary_threshold(camera_manager.plan, normalize_to_8bit(img))
+    return position
 
 def run_calibration(camera_manager):
     # Stage moves 10 microns in each direction
@@ -80,10 +101,10 @@ def run_calibration(camera_manager):
     for dx_um, dy_um in stage_moves:
         # Move stage
         camera_manager.primary_core.setRelativeXYPosition(dx_um, dy_um)
+        camera_manager.stage.moved(dx_um, dy_um)
         time.sleep(0.3)  # Allow time (300ms) for movement and image to update
-        #get the latest image
-        img = camera_manager.primary_core.popNextImage()
-        _, new_pos = binary_threshold(camera_manager, img)
+        #get the worm position in the latest image
+        new_pos = _newest_position(camera_manager)
         # Get new position
         if new_pos is None:
             print("Warning: object lost during calibration step.")
@@ -98,7 +119,8 @@ def run_calibration(camera_manager):
         pixel_shifts.append([shift_x, shift_y])
 
         # Move stage back before next step
-        core.setRelativeXYPosition(-dx_um, -dy_um)
+        camera_manager.primary_core.setRelativeXYPosition(-dx_um, -dy_um)
+        camera_manager.stage.moved(-dx_um, -dy_um)
         time.sleep(0.3)
 
     # Solve linear system: R = P × C → C = (P^T P)^-1 P^T R
@@ -116,10 +138,22 @@ def run_calibration(camera_manager):
     XXcorr, XYcorr = C[0]
     YXcorr, YYcorr = C[1]
 
-    tracking_settings["xx"] = XXcorr
-    tracking_settings["xy"] = XYcorr
-    tracking_settings["yx"] = YXcorr
-    tracking_settings["yy"] = YYcorr
+    # update the settings through the camera manager so the tracking plan is rebuilt
+    camera_manager.update_tracking_settings({"xx": XXcorr, "xy": XYcorr, "yx": YXcorr, "yy": YYcorr})
+    # keep the result so the next session with the same rig does not need to calibrate
+    camera_manager.save_calibration()
+
+"""
+Converts a displacement in pixels into a displacement in stage microns using the plan's
+calibration matrix (xx, xy, yx, yy times the scale in um/pixel). dx and dy can be single values
+or NumPy arrays, so the same conversion is used online by update_vectors and offline by
+trajectory_analysis.
+"""
+def pixel_to_stage(plan, dx, dy, gain=1):
+    calibration = plan.calibration
+    stage_x = (dx * calibration[0, 0] + dy * calibration[0, 1]) * gain
+    stage_y = (dx * calibration[1, 0] + dy * calibration[1, 1]) * gain
+    return stage_x, stage_y
 
 """
 This functions take in the current and previous positions which are calculated position as inputs. In addition,
@@ -131,7 +165,6 @@ of the stage movement.
 def update_vectors(camera_manager, x_vector, y_vector, dx, dy):
     current_position = camera_manager.current_position
     last_position = camera_manager.last_position
-    scale = camera_manager.tracking_tab_settings["scale"]
     if current_position is not None and last_position is not None:
         # Compute displacement from th center of our image
         new_dx = (camera_manager.img_width/2) - current_position[0]
@@ -139,25 +172,17 @@ def update_vectors(camera_manager, x_vector, y_vector, dx, dy):
         dx.update(new_dx)
         dy.update(new_dy)
 
-        # Convert pixel shift to stage movement using calibration factors
-        xx = camera_manager.tracking_tab_settings.get("xx")
-        xy = camera_manager.tracking_tab_settings.get("xy")
-        yx = camera_manager.tracking_tab_settings.get("yx")
-        yy = camera_manager.tracking_tab_settings.get("yy")
-        gain = camera_manager.tracking_tab_settings.get("gain")
-
-        #calculate movement vectors and scale them based on gain
-        # we multiply by scale to adjust the movement as the displacement is calculated inn pixels,
-        # but the vector to the stage is assumed to be microns.
-        new_x_vector = (dx.get_average() * xx + dy.get_average() * xy) * gain * scale
-        new_y_vector = (dx.get_average() * yx + dy.get_average() * yy) * gain * scale
+        # Convert pixel shift to stage movement using calibration factors, scaled by the gain
+        plan = camera_manager.plan
+        new_x_vector, new_y_vector = pixel_to_stage(plan, dx.get_average(), dy.get_average(), plan.gain)
         x_vector.update(new_x_vector)
         y_vector.update(new_y_vector)
 
         # we use the calculated object displacement to define the relative x, y coordinates.
         # this is different than setXYPosition because it doesn't move the stage to a fixed point.
         # instead, it only tells the stage to move in a given direction
-        #camera_manager.primary_core.setRelativeXYPosition(x_move, y_move)
+        if plan.stage_motion:
+            move_stage(camera_manager, x_vector.get_average(), y_vector.get_average())
 """ 
 the goal of this function is to take the x and y velocity vectors and use them them to 
 move the motorized staged based on object position
@@ -169,10 +194,14 @@ def move_stage(self, x_vector, y_vector):
         max_speed = 7 #Adjust based on hardware limits
         x_vector = max(-max_speed, min(max_speed, x_vector))
         y_vector = max(-max_speed, min(max_speed, y_vector))
+        # the runway is checked on the estimated position, so no position is read from the stage
+        x_vector, y_vector = self.stage.limit_move(x_vector, y_vector, self.plan.max_runway)
+        if x_vector == 0 and y_vector == 0:
+            return
 
         # Apply stage movement
         self.primary_core.setRelativeXYPosition(x_vector, y_vector)
-        print(f"Moving stage: X={x_vector}, Y={y_vector}")
+        self.stage.moved(x_vector, y_vector)
 
     except Exception as e:
-        print(f"Stage movement failed: {e}")
\ No newline at end of file
+        self.events.log("stage_move_failed", level="error", error=str(e))
\ No newline at end of file
@@ -0,0 +1,64 @@
+"""
+CalibrationCache: Calibration results kept on disk between sessions
+
+run_calibration moves the stage back and forth to measure the pixel-to-stage matrix, which only
+changes when the rig changes. Its results (xx, xy, yx, yy and scale) are saved in a JSON file
+in the user's home folder, keyed by the tracking camera device and the binning, together with
+a hash of the Micro-Manager configuration file they were measured with.
+
+When the cores are loaded the entry for the current camera and binning is applied to the
+tracking settings. If the configuration file has changed since the entry was saved, the values
+are still applied (they are usually closer than the defaults) but the entry is reported as
+stale so the rig can be recalibrated.
+
+"""
+
+import hashlib
+import json
+import os
+import time
+
+CACHE_PATH = os.path.join(os.path.expanduser("~"), ".worm_tracker", "calibration_cache.json")
+CALIBRATION_KEYS = ("xx", "xy", "yx", "yy", "scale")
+
+
+def config_hash(config_path):
+    with open(config_path, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def rig_key(camera, binning):
+    return f"{camera}|{binning}"
+
+
+class CalibrationCache:
+    def __init__(self, path=CACHE_PATH):
+        self.path = path
+        self.entries = {}
+        if os.path.isfile(path):
+            try:
+                with open(path) as f:
+                    self.entries = json.load(f)
+            except (OSError, ValueError) as e:
+                print(f"Could not read the calibration cache {path}: {e}")
+
+    def lookup(self, camera, binning, config_path):
+        """Returns (values, stale) for the rig, or (None, False) if it was never calibrated."""
+        entry = self.entries.get(rig_key(camera, binning))
+        if entry is None:
+            return None, False
+        stale = entry.get("config_hash") != config_hash(config_path)
+        return {key: entry[key] for key in CALIBRATION_KEYS if key in entry}, stale
+
+    def store(self, camera, binning, config_path, settings):
+        entry = {key: float(settings[key]) for key in CALIBRATION_KEYS}
+        entry["config_hash"] = config_hash(config_path)
+        entry["config_path"] = os.path.abspath(config_path)
+        entry["saved"] = time.strftime("%Y-%m-%d %H:%M:%S")
+        self.entries[rig_key(camera, binning)] = entry
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        # write to a temporary file first so an interrupted save cannot corrupt the cache
+        temporary = self.path + ".tmp"
+        with open(temporary, "w") as f:
+            json.dump(self.entries, f, indent=2)
+        os.replace(temporary, self.path)
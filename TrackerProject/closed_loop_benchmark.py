@@ -0,0 +1,256 @@
+"""
+closed_loop_benchmark: How well the whole tracking loop keeps a simulated worm centered
+
+Timing single functions does not tell whether the rig keeps the worm in the field of view. This
+runs the real per-frame pipeline (CameraManager -> process_tracking_frame -> detect_worm ->
+update_vectors -> move_stage) against a simulated rig: a worm crawls along a known path, frames
+are rendered from the worm's position relative to the stage, and the stage applies every
+relative move stage_lag_s after it was sent.
+
+Time in the simulation advances by frame periods, but processing is timed for real and counted
+as it would be on the rig: a frame is available at the end of its exposure, its processing
+starts when it is available or when the previous frame is done, whichever is later, its moves
+reach the stage after the processing time plus the stage lag, and the next frame processed is
+the newest one available when processing finishes (the "latest" frame policy), so slow
+processing costs dropped frames and waiting time. For every combination of fps, binning and
+gain the benchmark reports:
+- latency: time from the frame being available to the move being sent, waiting included (ms, percentiles),
+- centering error: distance between the worm and the center of the field of view (um, RMS),
+- lost-track events: times the worm was lost after having been found,
+- dropped frames.
+
+Results are saved as JSON (with the settings and the git commit) so runs before and after a
+change to the pipeline or the controller can be compared. The session files of each trial
+(event log, frame stats) are written to out_dir/sessions:
+    python closed_loop_benchmark.py --fps 10 20 40 --binning 2x2 4x4 --gain 1 5 10 --label new_gain
+
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import time
+import numpy as np
+import cv2
+from CameraManager import CameraManager
+from img_handling_functions import process_tracking_frame
+
+
+def worm_path(t, speed=80.0):
+    """Known position of the worm (um) at time t (s): a steady crawl with slow turns."""
+    x = speed * t + 150 * np.sin(0.5 * t)
+    y = 120 * np.sin(0.3 * t) + 60 * np.sin(1.1 * t)
+    return np.array([x, y])
+
+
+class SimulatedRig:
+    """
+    Stands in for the tracking core: renders the worm in the camera frame and moves the stage,
+    with each relative move taking effect stage_lag_s after it was sent.
+    """
+    def __init__(self, sensor_size=2048, stage_lag_s=0.05, noise=8.0, worm_size_um=(300.0, 40.0), seed=0):
+        self.sensor_size = sensor_size
+        self.worm_size_um = worm_size_um
+        self.configure(np.eye(2), 1)
+        self.stage_lag_s = stage_lag_s
+        self.noise = noise
+        self.rng = np.random.default_rng(seed)
+        self.stage_xy = np.zeros(2)
+        self.pending = []  # (time the move takes effect, dx, dy)
+        self.sent = []     # (perf_counter when sent, dx, dy) for the frame being processed
+
+    def configure(self, calibration, binning_factor):
+        """Sets the frame size and the optics so that the tracker's calibration is exact."""
+        self.width = self.height = self.sensor_size // binning_factor
+        # -inverse of the calibration, so that the tracker's moves bring the worm to the center
+        self.to_pixels = -np.linalg.inv(calibration)
+        um_per_pixel = np.sqrt(abs(np.linalg.det(calibration)))
+        self.axes = tuple(max(1, int(size / 2 / um_per_pixel)) for size in self.worm_size_um)
+
+    # the parts of the CMMCorePlus interface used by the tracking loop
+    def getCameraDevice(self):
+        return "SimulatedCamera"
+
+    def getXYStageDevice(self):
+        return "SimulatedStage"
+
+    def deviceBusy(self, device):
+        return False
+
+    def getXYPosition(self, device=None):
+        return float(self.stage_xy[0]), float(self.stage_xy[1])
+
+    def setRelativeXYPosition(self, dx, dy):
+        self.sent.append((time.perf_counter(), dx, dy))
+
+    def getImageWidth(self):
+        return self.width
+
+    def getImageHeight(self):
+        return self.height
+
+    def schedule(self, started_at, processing_start):
+        """
+        Queues the moves sent while processing a frame. started_at is when processing started in
+        simulated time, processing_start the perf_counter value at that moment.
+        """
+        for sent_at, dx, dy in self.sent:
+            self.pending.append((started_at + (sent_at - processing_start) + self.stage_lag_s, dx, dy))
+        self.sent = []
+
+    def advance(self, t):
+        """Applies the moves that have taken effect by time t."""
+        remaining = []
+        for effective_at, dx, dy in self.pending:
+            if effective_at <= t:
+                self.stage_xy += (dx, dy)
+            else:
+                remaining.append((effective_at, dx, dy))
+        self.pending = remaining
+
+    def render(self, t, worm_xy):
+        """Frame seen by the camera at time t: a dark worm on a bright, noisy background."""
+        frame = self.rng.normal(200, self.noise, (self.height, self.width))
+        center = np.array([self.width / 2, self.height / 2]) + self.to_pixels @ (worm_xy - self.stage_xy)
+        heading = worm_path(t + 0.05) - worm_xy
+        angle = np.degrees(np.arctan2(heading[1], heading[0]))
+        if np.all(np.abs(center) < 10 * self.width):
+            cv2.ellipse(frame, (int(center[0]), int(center[1])), self.axes, angle, 0, 360, 40, -1)
+        return np.clip(frame, 0, 255).astype(np.uint16)
+
+
+def run_trial(fps, binning, gain, duration_s=20.0, exposure_ms=10.0, stage_lag_s=0.05, settings=None, seed=0,
+              out_dir="benchmarks"):
+    """Runs the tracking loop for duration_s of simulated time and returns its summary."""
+    factor = int(binning.split("x")[0])
+    rig = SimulatedRig(stage_lag_s=stage_lag_s, seed=seed)
+    camera_manager = CameraManager(primary_core=rig)
+    # keep the trial's session files with the results instead of in the current folder
+    camera_manager.session_dir = os.path.join(out_dir, "sessions",
+                                              f"{time.strftime('%Y%m%d_%H%M%S')}_{fps:g}fps_{binning}_gain{gain:g}")
+    os.makedirs(camera_manager.session_dir, exist_ok=True)
+    # the default calibration is for 4x4 binning; the um per pixel scale with the binning
+    # stage motion is off by default in the GUI, the benchmark is about the closed loop
+    changes = {"fps": fps, "binning": binning, "gain": gain, "exposure": exposure_ms, "stage_motion": True,
+               "scale": camera_manager.tracking_tab_settings["scale"] * factor / 4}
+    changes.update(settings or {})
+    camera_manager.update_tracking_settings(changes)
+    rig.configure(camera_manager.plan.calibration, factor)
+    camera_manager.img_width, camera_manager.img_height = rig.width, rig.height
+    camera_manager.tracking_state.update({"prepare": "ON", "track": "ON"})
+    # start with the worm in the middle of the field of view
+    rig.stage_xy = worm_path(0.0).astype(float)
+    camera_manager.stage.resync()
+    camera_manager.stage.reset_origin()
+
+    period = 1.0 / fps
+    exposure_s = exposure_ms / 1000
+    latencies, errors, processing = [], [], []
+    lost_events = dropped = frames = 0
+    tracked = False
+    index = 0
+    busy_until = 0.0  # simulated time when the previous frame is done
+    while index * period < duration_s:
+        t = index * period  # start of the exposure
+        rig.advance(t)
+        worm_xy = worm_path(t)
+        frame = rig.render(t, worm_xy)
+        available_at = t + exposure_s
+        # a frame waits in the buffer while the previous one is still being processed
+        started_at = max(available_at, busy_until)
+        start = time.perf_counter()
+        process_tracking_frame(camera_manager, frame.ravel(), index)
+        elapsed = time.perf_counter() - start
+        latencies.extend(1000 * (started_at - available_at + sent_at - start) for sent_at, _, _ in rig.sent)
+        rig.schedule(started_at, start)
+        busy_until = started_at + elapsed
+
+        frames += 1
+        processing.append(1000 * elapsed)
+        errors.append(float(np.hypot(*(worm_xy - rig.stage_xy))))
+        found = camera_manager.current_position is not None
+        if tracked and not found:
+            lost_events += 1
+        tracked = found
+
+        # the next frame processed is the newest one read out when processing is done
+        next_index = max(index + 1, int(np.floor((busy_until - exposure_s) / period)))
+        dropped += next_index - index - 1
+        index = next_index
+
+    camera_manager.close_session_files()
+    camera_manager.events.close()
+    errors = np.array(errors)
+    latencies = np.array(latencies) if latencies else np.array([np.nan])
+    return {"fps": fps,
+            "binning": binning,
+            "gain": gain,
+            "frames": frames,
+            "dropped": dropped,
+            "processing_ms_mean": float(np.mean(processing)),
+            "latency_ms_p50": float(np.percentile(latencies, 50)),
+            "latency_ms_p95": float(np.percentile(latencies, 95)),
+            "latency_ms_p99": float(np.percentile(latencies, 99)),
+            "latency_ms_max": float(np.max(latencies)),
+            "moves": int(np.isfinite(latencies).sum()),
+            "centering_error_um_rms": float(np.sqrt(np.mean(errors ** 2))),
+            "centering_error_um_max": float(errors.max()),
+            "lost_track_events": lost_events,
+            "tracking_at_end": tracked}
+
+
+def _git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def run_benchmark(fps_values, binnings, gains, out_dir="benchmarks", label=None, **trial_options):
+    results = []
+    for fps in fps_values:
+        for binning in binnings:
+            for gain in gains:
+                result = run_trial(fps, binning, gain, out_dir=out_dir, **trial_options)
+                print(f"fps={fps} binning={binning} gain={gain}: latency p50 {result['latency_ms_p50']:.2f} ms "
+                      f"p95 {result['latency_ms_p95']:.2f} ms, centering error {result['centering_error_um_rms']:.1f} um "
+                      f"RMS, {result['lost_track_events']} lost, {result['dropped']} dropped")
+                results.append(result)
+
+    os.makedirs(out_dir, exist_ok=True)
+    name = time.strftime("%Y%m%d_%H%M%S") + (f"_{label}" if label else "")
+    path = os.path.join(out_dir, f"closed_loop_{name}.json")
+    with open(path, "w") as f:
+        json.dump({"label": label,
+                   "commit": _git_commit(),
+                   "trial_options": {key: value for key, value in trial_options.items() if key != "settings"},
+                   "settings": trial_options.get("settings"),
+                   "results": results}, f, indent=2)
+    print(f"Saved closed-loop benchmark to {path}")
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Closed-loop tracking benchmark on a simulated rig.")
+    parser.add_argument("--fps", type=float, nargs="+", default=[10, 20, 40])
+    parser.add_argument("--binning", nargs="+", default=["2x2", "4x4"])
+    parser.add_argument("--gain", type=float, nargs="+", default=[1, 5, 10])
+    parser.add_argument("--duration", type=float, default=20.0, help="simulated seconds per trial")
+    parser.add_argument("--stage-lag", type=float, default=0.05, help="seconds between sending a move and the stage moving")
+    parser.add_argument("--settings", help="JSON file with tracking_tab_settings to apply to every trial")
+    parser.add_argument("--label", help="name added to the results file")
+    parser.add_argument("--out-dir", default="benchmarks")
+    args = parser.parse_args()
+
+    settings = None
+    if args.settings:
+        with open(args.settings) as f:
+            settings = json.load(f)
+    run_benchmark(args.fps, args.binning, args.gain, out_dir=args.out_dir, label=args.label,
+                  duration_s=args.duration, stage_lag_s=args.stage_lag, settings=settings)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,131 @@
+"""
+EventLog: A structured, batched session log instead of prints in the live loops
+
+Printing on every frame costs milliseconds on a Windows console. Here the live loops only put
+small event records (time, level, event name and a few fields) on an in-memory queue, and a
+background thread writes them to the session's events.jsonl file in batches, one JSON object
+per line. Warnings and errors are also printed by that thread, so the console still shows what
+needs attention.
+
+Events are rate-limited per name: an event logged again within rate_limit_s of the last one that
+was written is not queued, only counted, and the next one written carries "repeated", the number
+of occurrences it stands for. Per-frame events such as the FPS therefore cost a dictionary lookup
+on most frames and produce about one line per second.
+
+Post-run tools read the file back with read_events or summarize:
+    from event_log import summarize
+    summarize("sessions/20250101_120000/events.jsonl")
+
+"""
+
+import collections
+import json
+import os
+import queue
+import threading
+import time
+
+LEVELS = {"debug": 10, "info": 20, "warning": 30, "error": 40}
+
+
+class EventLog:
+    def __init__(self, path_provider, rate_limit_s=1.0, echo_level="warning", flush_s=0.5, max_queue=10000):
+        # called by the writer thread when the first batch is written, so the session folder
+        # is not created by a GUI that never logs anything
+        self.path_provider = path_provider
+        self.rate_limit_s = rate_limit_s
+        self.echo_level = LEVELS[echo_level]
+        self.flush_s = flush_s
+        self.events = queue.Queue(maxsize=max_queue)
+        self.last_written = {}  # event name -> time it was last queued
+        self.suppressed = collections.Counter()
+        self.dropped = 0
+        self.path = None
+        self.lock = threading.Lock()
+        self.thread = threading.Thread(target=self._run, name="EventLog", daemon=True)
+        self.thread.start()
+
+    def log(self, event, level="info", **fields):
+        """Queues an event, unless the same event was queued less than rate_limit_s ago."""
+        now = time.time()
+        if now - self.last_written.get(event, 0.0) < self.rate_limit_s:
+            self.suppressed[event] += 1
+            return
+        self.last_written[event] = now
+        record = {"t": round(now, 4), "level": level, "event": event}
+        record.update(fields)
+        repeated = self.suppressed.pop(event, 0)
+        if repeated:
+            record["repeated"] = repeated + 1
+        try:
+            self.events.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def _write(self, batch):
+        with self.lock:
+            if self.path is None:
+                self.path = os.path.join(self.path_provider(), "events.jsonl")
+            with open(self.path, "a") as f:
+                f.write("".join(json.dumps(record, separators=(",", ":"), default=str) + "\n" for record in batch))
+        for record in batch:
+            if LEVELS.get(record["level"], 0) >= self.echo_level:
+                fields = " ".join(f"{key}={value}" for key, value in record.items() if key not in ("t", "level", "event"))
+                print(f"{record['level'].upper()}: {record['event']} {fields}")
+
+    def _run(self):
+        while True:
+            batch = [self.events.get()]
+            if batch[0] is None:
+                break
+            # collect what arrives within flush_s so the file is opened once per batch
+            deadline = time.time() + self.flush_s
+            stop = False
+            while True:
+                try:
+                    record = self.events.get(timeout=max(0.0, deadline - time.time()))
+                except queue.Empty:
+                    break
+                if record is None:
+                    stop = True
+                    break
+                batch.append(record)
+            self._write(batch)
+            if stop:
+                break
+
+    def flush(self):
+        """Writes the counts of events suppressed since they were last written, e.g. at the end of a session."""
+        now = time.time()
+        for event, count in list(self.suppressed.items()):
+            self.suppressed.pop(event, None)
+            try:
+                self.events.put_nowait({"t": round(now, 4), "level": "debug", "event": event, "repeated": count,
+                                        "suppressed_only": True})
+            except queue.Full:
+                self.dropped += count
+
+    def close(self):
+        self.flush()
+        self.events.put(None)
+        self.thread.join()
+
+
+def read_events(path, event=None, min_level="debug"):
+    """Yields the events of a session log, optionally only one event name or from a minimum level."""
+    threshold = LEVELS[min_level]
+    with open(path) as f:
+        for line in f:
+            record = json.loads(line)
+            if event is not None and record["event"] != event:
+                continue
+            if LEVELS.get(record["level"], 0) >= threshold:
+                yield record
+
+
+def summarize(path):
+    """Returns {event: number of occurrences}, counting the repetitions that were rate-limited."""
+    counts = collections.Counter()
+    for record in read_events(path):
+        counts[record["event"]] += record.get("repeated", 1)
+    return dict(counts)
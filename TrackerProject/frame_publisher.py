@@ -0,0 +1,171 @@
+"""
+FramePublisher / FrameReader: Live tracking frames in shared memory for other processes
+
+Other programs on the tracking computer (behavior classifiers, optogenetic triggers, ...) can
+follow the live tracking frames and worm positions without going through the GUI. The tracker
+writes every processed frame into a named shared-memory ring of a few slots; readers in other
+processes map the same memory and look at the newest slot, so neither side waits for the other
+and nothing is sent through pipes or sockets.
+
+Publishing is off unless "publish_frames" is set in tracking_tab_settings. Trackers running at
+the same time need different "shared_memory_name"s; a name already in use is never taken over.
+
+Layout of the shared memory (little endian):
+    header (64 bytes): magic, version, number of slots, frame height and width, dtype, index of
+                       the newest slot, number of frames published and a closed flag
+    slot headers (64 bytes each): seqlock counter, frame sequence number, timestamp, worm
+                       position in the frame (NaN when not detected) and stage position
+    frames: n_slots frames of height x width
+
+Each slot is protected by a seqlock: the publisher makes the counter odd before writing the
+slot and even again afterwards. A reader copies the slot header, reads the frame, and checks
+that the counter did not change; if it did, the slot was overwritten while reading and it tries
+again. Readers that use the frame without copying it (copy=False) can call is_current to check
+that the view was not overwritten in the meantime, which gives them n_slots - 1 frames of time.
+
+Reading from another process:
+    from frame_publisher import FrameReader
+    reader = FrameReader()
+    frame, info = reader.wait_for_frame()
+    print(info["seq"], info["x"], info["y"])
+
+"""
+
+import os
+import sys
+import time
+import numpy as np
+from multiprocessing import shared_memory
+
+DEFAULT_NAME = "worm_tracker_live"
+MAGIC = 0x57524D54  # "WRMT"
+LAYOUT_VERSION = 1
+HEADER_SIZE = 64
+SLOT_HEADER_SIZE = 64
+
+HEADER_DTYPE = np.dtype({"names": ["magic", "version", "n_slots", "height", "width", "dtype",
+                                   "latest", "published", "closed"],
+                         "formats": ["<u4", "<u4", "<u4", "<u4", "<u4", "S8", "<i8", "<u8", "<u4"],
+                         "offsets": [0, 4, 8, 12, 16, 20, 32, 40, 48],
+                         "itemsize": HEADER_SIZE})
+
+SLOT_DTYPE = np.dtype({"names": ["lock", "seq", "time", "x", "y", "stage_x", "stage_y"],
+                       "formats": ["<u8", "<i8", "<f8", "<f8", "<f8", "<f8", "<f8"],
+                       "offsets": [0, 8, 16, 24, 32, 40, 48],
+                       "itemsize": SLOT_HEADER_SIZE})
+
+
+def _segment_size(n_slots, frame_shape, dtype):
+    return HEADER_SIZE + n_slots * SLOT_HEADER_SIZE + n_slots * int(np.prod(frame_shape)) * np.dtype(dtype).itemsize
+
+
+def _views(buffer, n_slots, frame_shape, dtype):
+    header = np.ndarray((), dtype=HEADER_DTYPE, buffer=buffer)
+    slots = np.ndarray((n_slots,), dtype=SLOT_DTYPE, buffer=buffer, offset=HEADER_SIZE)
+    frames = np.ndarray((n_slots,) + tuple(frame_shape), dtype=dtype, buffer=buffer,
+                        offset=HEADER_SIZE + n_slots * SLOT_HEADER_SIZE)
+    return header, slots, frames
+
+
+class FramePublisher:
+    def __init__(self, frame_shape, dtype=np.uint8, n_slots=4, name=DEFAULT_NAME):
+        self.frame_shape = tuple(frame_shape)
+        self.dtype = np.dtype(dtype)
+        self.n_slots = n_slots
+        self.name = name
+        size = _segment_size(n_slots, self.frame_shape, self.dtype)
+        try:
+            self.shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+        except FileExistsError:
+            # the memory may belong to another tracker that is still running, so it is left alone
+            raise FileExistsError(f"Shared memory '{name}' is already in use, choose another shared_memory_name.")
+        self.header, self.slots, self.frames = _views(self.shm.buf, n_slots, self.frame_shape, self.dtype)
+        self.slots[:] = np.zeros(n_slots, dtype=SLOT_DTYPE)
+        self.header[()] = (MAGIC, LAYOUT_VERSION, n_slots, self.frame_shape[0], self.frame_shape[1],
+                           self.dtype.str.encode(), -1, 0, 0)
+        self.published = 0
+
+    def publish(self, frame, position, stage_xy, seq, timestamp):
+        if frame.shape != self.frame_shape:
+            return
+        index = self.published % self.n_slots
+        slot = self.slots[index:index + 1]
+        slot["lock"] += 1  # odd: being written
+        np.copyto(self.frames[index], frame, casting="unsafe")
+        x, y = position if position is not None else (np.nan, np.nan)
+        slot["seq"], slot["time"], slot["x"], slot["y"] = seq, timestamp, x, y
+        slot["stage_x"], slot["stage_y"] = stage_xy if stage_xy is not None else (np.nan, np.nan)
+        slot["lock"] += 1  # even: complete
+        self.published += 1
+        self.header["latest"] = index
+        self.header["published"] = self.published
+
+    def close(self):
+        self.header["closed"] = 1
+        # the views must be released before the memory can be closed
+        del self.header, self.slots, self.frames
+        self.shm.close()
+        self.shm.unlink()
+        print(f"Published {self.published} frames to shared memory '{self.name}'")
+
+
+class FrameReader:
+    def __init__(self, name=DEFAULT_NAME):
+        if sys.version_info >= (3, 13):
+            self.shm = shared_memory.SharedMemory(name=name, track=False)
+        else:
+            self.shm = shared_memory.SharedMemory(name=name)
+            # otherwise the reader's resource tracker would delete the tracker's memory when the reader
+            # exits; the resource tracker is only used for shared memory on POSIX systems
+            if os.name == "posix":
+                from multiprocessing import resource_tracker
+                resource_tracker.unregister(self.shm._name, "shared_memory")
+        header = np.ndarray((), dtype=HEADER_DTYPE, buffer=self.shm.buf)
+        if header["magic"] != MAGIC or header["version"] != LAYOUT_VERSION:
+            raise ValueError(f"Shared memory '{name}' was not written by a compatible FramePublisher.")
+        self.n_slots = int(header["n_slots"])
+        self.frame_shape = (int(header["height"]), int(header["width"]))
+        self.dtype = np.dtype(header["dtype"].item().decode())
+        self.header, self.slots, self.frames = _views(self.shm.buf, self.n_slots, self.frame_shape, self.dtype)
+
+    def closed(self):
+        """True when the publisher has stopped; a new FrameReader is needed for its next session."""
+        return bool(self.header["closed"])
+
+    def latest(self, copy=True):
+        """
+        Returns (frame, info) for the newest published frame, or None if there is none yet. info
+        is a copy of the slot header (seq, time, x, y, stage_x, stage_y). With copy=False the
+        frame is a view on the shared memory, see is_current.
+        """
+        for _ in range(1000):
+            index = int(self.header["latest"])
+            if index < 0 or self.closed():
+                return None
+            lock = int(self.slots[index]["lock"])
+            if lock % 2:
+                continue
+            info = self.slots[index].copy()
+            frame = self.frames[index].copy() if copy else self.frames[index]
+            if int(self.slots[index]["lock"]) == lock:
+                return frame, info
+        return None  # the publisher stopped in the middle of a write
+
+    def is_current(self, info):
+        """True if the frame returned with info has not been overwritten since it was read."""
+        matches = np.flatnonzero(self.slots["seq"] == info["seq"])
+        return len(matches) > 0 and int(self.slots[matches[0]]["lock"]) == int(info["lock"])
+
+    def wait_for_frame(self, last_seq=None, timeout=1.0, copy=True):
+        """Waits until a frame newer than last_seq is published. Returns None on timeout."""
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            result = self.latest(copy)
+            if result is not None and (last_seq is None or result[1]["seq"] > last_seq):
+                return result
+            time.sleep(0.001)
+        return None
+
+    def close(self):
+        del self.header, self.slots, self.frames
+        self.shm.close()
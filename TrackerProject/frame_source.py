@@ -0,0 +1,104 @@
+"""
+frame_source: Taking frames out of a Micro-Manager core with frame-drop accounting
+
+Every timer tick the live loops empty the core's circular buffer. pop_frames does this while
+keeping track of frame sequence numbers (the "ImageNumber" tag of the image metadata, or a
+counter when the camera does not provide one), so we know how many frames were received,
+processed, displayed and dropped. Dropped frames are the ones discarded from the backlog plus
+the gaps in the sequence numbers, i.e. frames that were lost before we could pop them.
+
+Consumption policies:
+- "latest": only the newest frame is processed, the backlog is dropped (for stage control).
+- "all": every frame is processed (for recording and analysis).
+- "every_nth": only frames whose sequence number is a multiple of N are processed; the others
+  are counted as skipped, not dropped, since leaving them out is intended. This also holds for
+  frames lost between samples: only lost frames that would have been sampled are dropped.
+
+"""
+
+import time
+
+FRAME_POLICIES = ("latest", "all", "every_nth")
+
+
+class FrameStats:
+    def __init__(self, name):
+        self.name = name
+        self.reset()
+
+    def reset(self):
+        self.received = 0
+        self.processed = 0
+        self.displayed = 0
+        self.dropped = 0
+        self.skipped = 0
+        self.last_seq = None
+        self.counter = 0
+        self.start_time = time.time()
+
+    def drop_fraction(self):
+        total = self.processed + self.dropped
+        return self.dropped / total if total > 0 else 0.0
+
+    def undersampled(self, max_drop_fraction=0.05):
+        """True when more than max_drop_fraction of the frames that should have been processed were lost."""
+        return self.drop_fraction() > max_drop_fraction
+
+    def summary(self):
+        return {"name": self.name,
+                "received": self.received,
+                "processed": self.processed,
+                "displayed": self.displayed,
+                "dropped": self.dropped,
+                "skipped": self.skipped,
+                "drop_fraction": self.drop_fraction(),
+                "undersampled": self.undersampled(),
+                "duration_s": time.time() - self.start_time}
+
+    def __str__(self):
+        return (f"processed {self.processed}, displayed {self.displayed}, dropped {self.dropped} "
+                f"({100 * self.drop_fraction():.1f}%), skipped {self.skipped}")
+
+
+def _sequence_number(stats, metadata):
+    stats.counter += 1
+    try:
+        return int(metadata.get("ImageNumber"))
+    except (AttributeError, KeyError, TypeError, ValueError):
+        return stats.counter
+
+
+def pop_frames(core, stats, policy="latest", every_n=2):
+    """
+    Pops every frame waiting in the core's buffer and returns the ones to process according to
+    policy, as a list of (flat image, sequence number), oldest first.
+    """
+    frames = []
+    for _ in range(core.getRemainingImageCount()):
+        img, metadata = core.popNextImageAndMD()
+        seq = _sequence_number(stats, metadata)
+        # a jump in the sequence numbers means frames were lost before they reached us
+        if stats.last_seq is not None and seq > stats.last_seq + 1:
+            missing = seq - stats.last_seq - 1
+            if policy == "every_nth":
+                # only the lost frames that would have been sampled undersample us, the others
+                # would have been skipped anyway
+                n = max(1, every_n)
+                lost_samples = (seq - 1) // n - stats.last_seq // n
+                stats.dropped += lost_samples
+                stats.skipped += missing - lost_samples
+            else:
+                stats.dropped += missing
+        stats.last_seq = seq
+        stats.received += 1
+
+        if policy == "every_nth" and seq % max(1, every_n) != 0:
+            stats.skipped += 1
+            continue
+        frames.append((img, seq))
+
+    if policy == "latest" and len(frames) > 1:
+        stats.dropped += len(frames) - 1
+        frames = frames[-1:]
+    stats.processed += len(frames)
+    return frames
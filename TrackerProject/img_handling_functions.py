@@ -6,6 +6,11 @@ import numpy as np
 import os
 from functools import partial
 from binary_tracker import *
+from trajectory_analysis import SessionLogWriter
+from posture import PostureWorker
+from multi_worm_tracker import find_blobs, blobs_to_stage
+from roi_recorder import RoiRecorder
+from frame_source import pop_frames
 
 """Normalize images of different bit depths to 8-bit (0-255)."""
 def normalize_to_8bit(img):
@@ -19,59 +24,130 @@ def normalize_to_8bit(img):
     return img.astype(np.uint8)
 
 
+"""
+Processes one frame of the tracking camera (binarization, tracking, logging and recording)
+and returns the image to display for it. seq is the frame's sequence number.
+"""
+def process_tracking_frame(camera_manager, img_1, seq, newest=True):
+    # since MM produces the image in the form of a fattened array (1D),
+    # we need to reshape it to a 2D array that can be "seen" as an image
+    img_1 = img_1.reshape((camera_manager.img_height, camera_manager.img_width))
+    # keep the raw frame for recording, the normalized one is only used for tracking and display
+    raw_img_1 = img_1
+    # Normalize before passing to Napari
+    img_1 = normalize_to_8bit(img_1)
+
+    # upload the live feed with the binary image rather than the original img_1
+    if camera_manager.tracking_state["prepare"] != "ON":
+        if camera_manager.replay is not None:
+            camera_manager.replay.push(img_1, None, None, seq, time.time())
+        if camera_manager.publisher is not None:
+            camera_manager.publisher.publish(img_1, None, None, seq, time.time())
+        return img_1
+
+    # read the plan once so the whole frame is processed with the same settings
+    plan = camera_manager.plan
+    binary_frame, detection = detect_worm(plan, img_1)
+    current_position = detection.center if detection is not None else None
+    camera_manager.current_position = current_position
+    camera_manager.detection = detection
+    # estimated from the commanded moves, the controller is only queried every stage_resync_s
+    stage_xy = camera_manager.stage.get_position()
+    # let other programs follow the frame and the worm through shared memory
+    if camera_manager.publisher is not None:
+        camera_manager.publisher.publish(img_1, current_position, stage_xy, seq, time.time())
+    # keep the frame for instant replay, this only copies it into a preallocated slot
+    if camera_manager.replay is not None:
+        camera_manager.replay.push(img_1, binary_frame, current_position, seq, time.time())
+    # in multi-worm mode every blob is tracked, while the stage keeps following the largest one
+    multi_tracker = camera_manager.multi_tracker
+    if multi_tracker is not None:
+        # the binary frame has nothing drawn on it, so the blobs are found in it directly
+        centroids, areas = find_blobs(binary_frame, plan.min_blob_area)
+        # matched in stage microns, so moving the stage does not move the worms
+        multi_tracker.update(seq, blobs_to_stage(plan, centroids, stage_xy, camera_manager.img_width,
+                                                 camera_manager.img_height), areas)
+    # focus is adjusted from the sharpness of the raw ROI, the Z moves are sent from another thread
+    if camera_manager.focus_tracker is not None:
+        camera_manager.focus_tracker.process(raw_img_1, current_position, plan.square_size, seq)
+    # in record mode only the window around the worm is saved, with its position in the frame,
+    # in a new folder every time Record is turned on
+    if camera_manager.tracking_state["record"] == "ON":
+        if camera_manager.roi_recorder is None:
+            camera_manager.roi_recorder = RoiRecorder(
+                os.path.join(camera_manager.get_session_dir(), f"roi_recording_{time.strftime('%H%M%S')}"),
+                plan.square_size)
+        camera_manager.roi_recorder.write(raw_img_1, current_position, stage_xy, time.time(), seq)
+    if camera_manager.tracking_state["track"] == "ON":
+        # log the stage and worm positions so the trajectory can be reconstructed offline,
+        # one file per tracking run so turning Track off and on does not overwrite the last one
+        if plan.save_stage_positions:
+            if camera_manager.session_log is None:
+                camera_manager.session_log = SessionLogWriter(
+                    os.path.join(camera_manager.get_session_dir(), f"stage_positions_{time.strftime('%H%M%S')}.csv"))
+            camera_manager.session_log.write_row(time.time(),
+                                                 stage_xy,
+                                                 current_position,
+                                                 camera_manager.img_width,
+                                                 camera_manager.img_height)
+        # posture is extracted in a background thread on every Nth tracked frame, one file per run
+        if plan.posture_every_n > 0:
+            if camera_manager.posture_worker is None:
+                camera_manager.posture_worker = PostureWorker(
+                    os.path.join(camera_manager.get_session_dir(), f"posture_{time.strftime('%H%M%S')}.bin"),
+                    plan.posture_every_n, plan.posture_points)
+            camera_manager.posture_worker.submit(plan, seq, time.time(), img_1, current_position)
+        # paste every Nth frame into the map of the explored runway
+        mosaic = camera_manager.mosaic
+        if mosaic is not None and seq % mosaic.every_n == 0:
+            mosaic.submit(plan, img_1, stage_xy)
+        dx = MovingAvg(2)
+        dy = MovingAvg(2)
+        x_vector = MovingAvg(2)
+        y_vector = MovingAvg(2)
+        if camera_manager.last_position is None and current_position is not None:
+            camera_manager.last_position = current_position
+        elif newest:
+            # older frames of a batch are only logged and analysed, the stage follows the newest one
+            camera_manager.events.log("update_vectors", level="debug", last_position=camera_manager.last_position,
+                                      current_position=current_position)
+            update_vectors(camera_manager, x_vector, y_vector, dx, dy) #dx and dy are MovingAvg class
+    return binary_frame
+
+
 """ 
 This function initiates a live from the tracking camera based on user inputs of exposure and fps.
 It returns an image that cna be passed onto the layer_1 of the napari viewer
 """
-def tracking_start_live(camera_manager, layer_1):
-    print("starting tracking updater")
+def tracking_start_live(camera_manager, layer_1, overlay=None):
     while camera_manager.primary_core.getRemainingImageCount() == 0:
-        print("no frame loaded")
+        camera_manager.events.log("tracking_no_frame", level="debug")
         time.sleep(0.01)  # Small delay to allow frames to arrive
 
-    if camera_manager.primary_core.getRemainingImageCount() > 0:  # Ensure there's a new frame
-        # this generates a tuple where the first element the next frame in
-        # the circular buffer, removing it and allowing is to work with it
-        while camera_manager.primary_core.getRemainingImageCount() > 1:
-
-            camera_manager.primary_core.popNextImage()
-
-    img_1 = camera_manager.primary_core.popNextImage()
+    # take the frames out of the circular buffer; which of them are processed depends on the
+    # frame policy, and the ones that are thrown away are counted in tracking_stats
+    frames = pop_frames(camera_manager.primary_core, camera_manager.tracking_stats,
+                        camera_manager.plan.frame_policy, camera_manager.plan.every_n_frames)
+    if not frames:
+        return
 
-    if img_1 is None or img_1.size == 0:
-        print("Error: No image data received from camera.")
-        return  # Exit to prevent passing None to Napari
-
-    # since MM produces the image in the form of a fattened array (1D),
-    # we need to reshape it to a 2D array that can be "seen" as an image
-    img_1 = img_1.reshape((camera_manager.primary_core.getImageHeight(),
-                           camera_manager.primary_core.getImageWidth()))
     camera_manager.img_width = camera_manager.primary_core.getImageWidth()
     camera_manager.img_height = camera_manager.primary_core.getImageHeight()
-    # Normalize before passing to Napari
-    img_1 = normalize_to_8bit(img_1)
-
-    # upload the live feed with the binary image rather than the original img_1
-    if camera_manager.tracking_state["prepare"] == "ON":
-        binary_frame, current_position = binary_threshold(camera_manager, img_1)
-        camera_manager.current_position = current_position
-        layer_1.data = binary_frame
-        layer_1.refresh()
-        if camera_manager.tracking_state["track"] == "ON":
-            dx = MovingAvg(2)
-            dy = MovingAvg(2)
-            x_vector = MovingAvg(2)
-            y_vector = MovingAvg(2)
-            if camera_manager.last_position is None and current_position is not None:
-                camera_manager.last_position = current_position
-            else:
-                print(f"las position: {camera_manager.last_position}")
-                update_vectors(camera_manager, x_vector, y_vector, dx, dy) #dx and dy are MovingAvg class
-
-    else:
-        # upload image onto layer
-        layer_1.data = img_1
-        layer_1.refresh()
+    display_frame = None
+    for index, (img_1, seq) in enumerate(frames):
+        if img_1 is None or img_1.size == 0:
+            camera_manager.events.log("tracking_empty_frame", level="error", seq=seq)
+            continue  # Skip the frame to prevent passing None to Napari
+        display_frame = process_tracking_frame(camera_manager, img_1, seq, newest=index == len(frames) - 1)
+    if display_frame is None:
+        return
+
+    # only the newest frame is displayed; setting the data already redraws the layer
+    layer_1.data = display_frame
+    camera_manager.tracking_stats.displayed += 1
+    # the ROI, center and outline are drawn as napari layers on top of the frame
+    if overlay is not None:
+        overlay.update(camera_manager.detection if camera_manager.tracking_state["prepare"] == "ON" else None)
 
     # Calculate actual FPS
     if camera_manager.last_tracking_frame_time is not None:
@@ -82,39 +158,40 @@ def tracking_start_live(camera_manager, layer_1):
             real_tracking_fps = 0
     camera_manager.last_tracking_frame_time = time.time()  # Update last frame time
 
-    print(f"Tracking FPS: {real_tracking_fps:.2f}")
+    camera_manager.events.log("tracking_fps", fps=round(real_tracking_fps, 2), frames=len(frames),
+                              dropped=camera_manager.tracking_stats.dropped)
 
 
 def recording_start_live(camera_manager, layer_2):
-    print("starting tracking updater")
     while camera_manager.secondary_core.getRemainingImageCount() == 0:
-        print("no frame loaded")
+        camera_manager.events.log("recording_no_frame", level="debug")
         time.sleep(0.01)  # Small delay to allow frames to arrive
 
-    if camera_manager.secondary_core.getRemainingImageCount() > 0:  # Ensure there's a new frame
-        # this generates a tuple where the first element the next frame in
-        # the circular buffer, removing it and allowing is to work with it
-        while camera_manager.secondary_core.getRemainingImageCount() > 1:
-            camera_manager.secondary_core.popNextImage()
-
-    img_2 = camera_manager.secondary_core.popNextImage()
+    # nothing but the display uses the recording camera's frames for now, so every frame is taken
+    # out of the buffer, only the newest is shown and the older ones are counted as skipped;
+    # dropped frames are then only the ones lost before they were popped
+    frames = pop_frames(camera_manager.secondary_core, camera_manager.recording_stats, "all")
+    if not frames:
+        return
+    if len(frames) > 1:
+        camera_manager.recording_stats.processed -= len(frames) - 1
+        camera_manager.recording_stats.skipped += len(frames) - 1
+    img_2 = frames[-1][0]
 
     if img_2 is None or img_2.size == 0:
-        print("Error: No image data received from camera.")
+        camera_manager.events.log("recording_empty_frame", level="error", seq=frames[-1][1])
         return  # Exit to prevent passing None to Napari
 
     # since MM produces the image in the form of a fattened array (1D),
     # we need to reshape it to a 2D array that can be "seen" as an image
     img_2 = img_2.reshape((camera_manager.secondary_core.getImageHeight(),
                            camera_manager.secondary_core.getImageWidth()))
-    print("img_2 reshaped")
     # Normalize before passing to Napari
     img_2 = normalize_to_8bit(img_2)
-    print("img_2 normalized")
 
-    print("updating layer_2")
+    # setting the data already redraws the layer
     layer_2.data = img_2
-    layer_2.refresh()
+    camera_manager.recording_stats.displayed += 1
 
     # Calculate actual FPS
     if camera_manager.last_recording_frame_time is not None:
@@ -122,7 +199,8 @@ def recording_start_live(camera_manager, layer_2):
         if recording_frame_time > 0:
             real_recording_fps = 1 / recording_frame_time
         else:
-            real_tracking_fps = 0
+            real_recording_fps = 0
     camera_manager.last_recording_frame_time = time.time()  # Update last frame time
 
-    print(f"Recording FPS: {real_recording_fps:.2f}")
+    camera_manager.events.log("recording_fps", fps=round(real_recording_fps, 2), frames=len(frames),
+                              dropped=camera_manager.recording_stats.dropped)
@@ -0,0 +1,190 @@
+"""
+MdaRecorder: Hardware-sequenced recording with the pymmcore-plus MDA engine
+
+The live loops pace acquisition with QTimers, so the frame rate of a recording depends on how
+busy the GUI is. For recordings the timing should come from the camera instead: the recording is
+described as a useq.MDASequence of time points that all share the same start time, which the
+MDA engine merges into a single hardware sequence (startSequenceAcquisition on the camera). The
+camera then runs at the rate set by its own frame rate property, or by the external trigger
+selected in CameraManager._setup_camera, and pymmcore-plus pops the frames in its own thread.
+
+Frames arrive through the engine's frameReady event together with their metadata and are
+written straight into fixed-shape .npy chunks on that thread, with a metadata table per chunk.
+When the sequence finishes the achieved frame rate and the number of dropped frames (gaps in
+the camera's ImageNumber) are printed.
+
+Run this file to record from the pymmcore-plus demo configuration:
+    python mda_recording.py
+
+"""
+
+import json
+import os
+import numpy as np
+import useq
+
+META_DTYPE = np.dtype([("frame", "<i8"),         # camera ImageNumber, or the MDA time index
+                       ("runner_time_ms", "<f8"),  # time since the start of the sequence
+                       ("camera_time_ms", "<f8")])  # camera ElapsedTime-ms, NaN if not provided
+
+FRAME_RATE_PROPERTIES = ("FrameRate", "Frame Rate", "AcquisitionFrameRate", "Framerate")
+
+
+def build_sequence(n_frames):
+    """A sequence of n_frames time points with no interval, so they can be hardware sequenced."""
+    return useq.MDASequence(time_plan={"interval": 0, "loops": n_frames})
+
+
+def set_frame_rate(core, camera, fps):
+    """Sets the camera's frame rate property if it has one. Returns True if it was set."""
+    for name in FRAME_RATE_PROPERTIES:
+        if core.hasProperty(camera, name) and not core.isPropertyReadOnly(camera, name):
+            core.setProperty(camera, name, fps)
+            return True
+    return False
+
+
+def _camera_tag(meta, key):
+    try:
+        return float(meta.get("camera_metadata", {}).get(key))
+    except (TypeError, ValueError):
+        return np.nan
+
+
+class FrameStackWriter:
+    """Writes full frames into frames_XXXXX.npy chunks, with meta_XXXXX.npy and index.json."""
+    def __init__(self, directory, chunk_frames=500):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self.chunk_frames = chunk_frames
+        self.frame_shape = None
+        self.dtype = None
+        self.chunks = []
+        self.chunk = None
+        self.meta = np.zeros(chunk_frames, dtype=META_DTYPE)
+        self.index = 0
+        self.frames = 0
+
+    def _open_chunk(self):
+        name = f"frames_{len(self.chunks):05d}.npy"
+        self.chunks.append(name)
+        self.chunk = np.lib.format.open_memmap(os.path.join(self.directory, name), mode="w+", dtype=self.dtype,
+                                               shape=(self.chunk_frames,) + self.frame_shape)
+        self.index = 0
+
+    def _close_chunk(self):
+        name = self.chunks[-1]
+        path = os.path.join(self.directory, name)
+        self.chunk.flush()
+        if self.index < self.chunk_frames:
+            frames = np.array(self.chunk[:self.index])
+            del self.chunk
+            np.save(path, frames)
+        np.save(os.path.join(self.directory, name.replace("frames_", "meta_")), self.meta[:self.index])
+        self.chunk = None
+
+    def write(self, frame, frame_number, runner_time_ms, camera_time_ms):
+        if self.frame_shape is None:
+            self.frame_shape = frame.shape
+            self.dtype = frame.dtype
+        if self.chunk is None:
+            self._open_chunk()
+        self.chunk[self.index] = frame
+        self.meta[self.index] = (frame_number, runner_time_ms, camera_time_ms)
+        self.index += 1
+        self.frames += 1
+        if self.index == self.chunk_frames:
+            self._close_chunk()
+
+    def close(self, **info):
+        if self.chunk is not None:
+            self._close_chunk()
+        with open(os.path.join(self.directory, "index.json"), "w") as f:
+            json.dump({"frames": self.frames,
+                       "frame_shape": list(self.frame_shape) if self.frame_shape else None,
+                       "dtype": str(self.dtype),
+                       "chunks": self.chunks,
+                       **info}, f, indent=2)
+
+
+class MdaRecorder:
+    def __init__(self, core, directory, fps, duration_s, exposure=None, chunk_frames=500):
+        self.core = core
+        self.directory = directory
+        self.fps = fps
+        self.n_frames = max(1, int(round(fps * duration_s)))
+        self.exposure = exposure
+        self.writer = FrameStackWriter(directory, chunk_frames)
+        self.last_number = None
+        self.dropped = 0
+        self.first_time = None
+        self.last_time = None
+        self.thread = None
+
+    def running(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    def start(self):
+        core = self.core
+        camera = core.getCameraDevice()
+        if self.exposure is not None:
+            core.setExposure(min(self.exposure, 1000 / self.fps))
+        if not set_frame_rate(core, camera, self.fps):
+            print(f"{camera} has no frame rate property, the rate is set by its exposure or external trigger.")
+        core.mda.engine.use_hardware_sequencing = True
+        core.mda.events.frameReady.connect(self.frame_ready)
+        core.mda.events.sequenceFinished.connect(self.sequence_finished)
+        print(f"Recording {self.n_frames} frames at {self.fps} fps to {self.directory}")
+        self.thread = core.run_mda(build_sequence(self.n_frames))
+        return self.thread
+
+    def frame_ready(self, image, event, meta):
+        # runs on the MDA thread, once per frame, in acquisition order
+        number = _camera_tag(meta, "ImageNumber")
+        number = event.index.get("t", 0) if np.isnan(number) else int(number)
+        if self.last_number is not None and number > self.last_number + 1:
+            self.dropped += number - self.last_number - 1
+        self.last_number = number
+        camera_time = _camera_tag(meta, "ElapsedTime-ms")
+        timestamp = camera_time if not np.isnan(camera_time) else meta.get("runner_time_ms", np.nan)
+        if self.first_time is None:
+            self.first_time = timestamp
+        self.last_time = timestamp
+        self.writer.write(image, number, meta.get("runner_time_ms", np.nan), camera_time)
+
+    def measured_fps(self):
+        frames = self.writer.frames
+        if frames < 2 or not self.last_time > self.first_time:
+            return float("nan")
+        return 1000 * (frames - 1) / (self.last_time - self.first_time)
+
+    def sequence_finished(self, sequence):
+        self.core.mda.events.frameReady.disconnect(self.frame_ready)
+        self.core.mda.events.sequenceFinished.disconnect(self.sequence_finished)
+        fps = self.measured_fps()
+        self.writer.close(target_fps=self.fps, measured_fps=fps, dropped=self.dropped)
+        print(f"Saved {self.writer.frames} frames to {self.directory} at {fps:.2f} fps "
+              f"(target {self.fps}), {self.dropped} dropped")
+
+    def stop(self):
+        """Cancels the recording; the frames acquired so far are kept."""
+        if self.running():
+            self.core.mda.cancel()
+            self.thread.join()
+
+
+def demo(fps=20, duration_s=2.0, directory="mda_demo"):
+    """Records from the pymmcore-plus demo configuration and checks the saved frames."""
+    import pymmcore_plus
+    core = pymmcore_plus.CMMCorePlus()
+    core.loadSystemConfiguration()  # demo configuration
+    recorder = MdaRecorder(core, directory, fps, duration_s, exposure=10)
+    recorder.start().join()
+    with open(os.path.join(directory, "index.json")) as f:
+        index = json.load(f)
+    assert index["frames"] == recorder.n_frames, index
+    print(index)
+
+
+if __name__ == "__main__":
+    demo()
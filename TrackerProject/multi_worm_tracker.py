@@ -0,0 +1,159 @@
+"""
+MultiWormTracker: Tracking every worm on the plate with stable identities
+
+binary_threshold only keeps the largest contour, which is what the stage follows. For plates
+with several animals (and for offline screening recordings) this module finds every blob above
+a minimum area in a single connected-components pass and links them from frame to frame.
+
+Identities are assigned with a cost matrix of distances between the tracks and the new
+detections, computed in one NumPy operation. The Hungarian algorithm is used when SciPy is
+installed; otherwise detections are matched greedily, nearest pair first. Detections that are
+not matched start new tracks (births), and tracks that go unmatched for more than max_missed
+frames are closed (deaths).
+
+During live tracking the stage moves under the worms, so the centroids are converted to stage
+microns with blobs_to_stage before they are matched and saved; a worm that stays still keeps its
+coordinates when the stage follows another one. Offline recordings have no stage position and
+are tracked in pixels.
+
+"""
+
+import numpy as np
+import cv2
+from binary_tracker import binarize_frame, pixel_to_stage
+from tracking_plan import compile_plan
+
+try:
+    from scipy.optimize import linear_sum_assignment
+except ImportError:
+    linear_sum_assignment = None
+
+
+TRACK_COLUMNS = ("frame", "id", "x", "y", "area")
+
+
+def find_blobs(binary_frame, min_area):
+    """Returns the centroids (N, 2) and areas (N,) of all white blobs of at least min_area pixels."""
+    _, _, stats, centroids = cv2.connectedComponentsWithStats(binary_frame, connectivity=8)
+    # label 0 is the background
+    areas = stats[1:, cv2.CC_STAT_AREA]
+    keep = areas >= min_area
+    return centroids[1:][keep], areas[keep]
+
+
+def detect_blobs(plan, frame, min_area):
+    return find_blobs(binarize_frame(plan, frame), min_area)
+
+
+def blobs_to_stage(plan, centroids, stage_xy, img_width, img_height):
+    """
+    Converts centroids (N, 2) in pixels into stage positions in microns, measured from the center
+    of the frame like the worm positions in trajectory_analysis.
+    """
+    stage_dx, stage_dy = pixel_to_stage(plan, img_width / 2 - centroids[:, 0], img_height / 2 - centroids[:, 1])
+    return np.column_stack((stage_xy[0] + stage_dx, stage_xy[1] + stage_dy))
+
+
+def _greedy_assignment(cost):
+    """Matches the cheapest pairs first. Returns row and column indices like linear_sum_assignment."""
+    rows, cols = [], []
+    used_rows = np.zeros(cost.shape[0], bool)
+    used_cols = np.zeros(cost.shape[1], bool)
+    for flat in np.argsort(cost, axis=None):
+        row, col = divmod(int(flat), cost.shape[1])
+        if not used_rows[row] and not used_cols[col]:
+            used_rows[row] = used_cols[col] = True
+            rows.append(row)
+            cols.append(col)
+            if len(rows) == min(cost.shape):
+                break
+    return np.array(rows, dtype=int), np.array(cols, dtype=int)
+
+
+class MultiWormTracker:
+    def __init__(self, max_distance=30.0, max_missed=5, use_hungarian=True):
+        self.max_distance = max_distance  # largest jump between frames for the same worm, in the centroids' units
+        self.max_missed = max_missed
+        self.use_hungarian = use_hungarian and linear_sum_assignment is not None
+        self.next_id = 0
+        # state of the live tracks, one row per track
+        self.ids = np.empty(0, dtype=np.int64)
+        self.positions = np.empty((0, 2))
+        self.missed = np.empty(0, dtype=np.int64)
+        # every detection that was assigned to a track, as rows of TRACK_COLUMNS
+        self.rows = []
+
+    def update(self, frame_index, centroids, areas):
+        """Assigns the detections of one frame to tracks and returns their IDs, in detection order."""
+        detection_ids = np.full(len(centroids), -1, dtype=np.int64)
+        matched_tracks = np.zeros(len(self.ids), bool)
+
+        if len(self.ids) > 0 and len(centroids) > 0:
+            cost = np.linalg.norm(self.positions[:, None, :] - centroids[None, :, :], axis=2)
+            if self.use_hungarian:
+                track_index, detection_index = linear_sum_assignment(cost)
+            else:
+                track_index, detection_index = _greedy_assignment(cost)
+            close = cost[track_index, detection_index] <= self.max_distance
+            track_index, detection_index = track_index[close], detection_index[close]
+
+            detection_ids[detection_index] = self.ids[track_index]
+            self.positions[track_index] = centroids[detection_index]
+            self.missed[track_index] = 0
+            matched_tracks[track_index] = True
+
+        # tracks without a detection age, and are closed when they have been missing too long
+        self.missed[~matched_tracks] += 1
+        alive = self.missed <= self.max_missed
+        self.ids, self.positions, self.missed = self.ids[alive], self.positions[alive], self.missed[alive]
+
+        # detections without a track are new worms
+        born = np.flatnonzero(detection_ids < 0)
+        if len(born) > 0:
+            new_ids = np.arange(self.next_id, self.next_id + len(born))
+            self.next_id += len(born)
+            detection_ids[born] = new_ids
+            self.ids = np.concatenate((self.ids, new_ids))
+            self.positions = np.vstack((self.positions, centroids[born]))
+            self.missed = np.concatenate((self.missed, np.zeros(len(born), dtype=np.int64)))
+
+        if len(centroids) > 0:
+            self.rows.append(np.column_stack((np.full(len(centroids), frame_index), detection_ids,
+                                              centroids, areas)))
+        return detection_ids
+
+    def table(self):
+        """Returns every assigned detection as an array with the columns in TRACK_COLUMNS."""
+        if not self.rows:
+            return np.empty((0, len(TRACK_COLUMNS)))
+        return np.concatenate(self.rows)
+
+    def tracks(self):
+        """Returns a dictionary {id: array of (frame, x, y, area)} with one trajectory per worm."""
+        table = self.table()
+        order = np.lexsort((table[:, 0], table[:, 1]))
+        table = table[order]
+        ids, starts = np.unique(table[:, 1], return_index=True)
+        return {int(worm_id): trajectory[:, [0, 2, 3, 4]]
+                for worm_id, trajectory in zip(ids, np.split(table, starts[1:]))}
+
+    def save(self, path):
+        np.savetxt(path, self.table(), delimiter=",", header=",".join(TRACK_COLUMNS),
+                   comments="", fmt=["%d", "%d", "%.2f", "%.2f", "%d"])
+        print(f"Saved {self.next_id} worm tracks to {path}")
+
+
+def track_recording(stack_path, tracking_tab_settings, out_path=None, min_area=50, **tracker_options):
+    """
+    Tracks every worm in a recording saved as a (frames, height, width) .npy stack. The stack is
+    memory-mapped, so only one frame is in memory at a time.
+    """
+    plan = compile_plan(tracking_tab_settings)
+    frames = np.load(stack_path, mmap_mode="r")
+    tracker = MultiWormTracker(**tracker_options)
+    for i in range(len(frames)):
+        centroids, areas = detect_blobs(plan, np.asarray(frames[i]), min_area)
+        tracker.update(i, centroids, areas)
+    if out_path is not None:
+        tracker.save(out_path)
+    return tracker.tracks()
@@ -0,0 +1,210 @@
+"""
+parameter_sweep: Choosing threshold, erode, dilate and square_size from recorded frames
+
+Instead of trial and error in the GUI, this runs detect_worm over a sample of recorded
+frames for every combination of a grid of parameters, in a process pool, and scores each
+combination on:
+- detection rate: fraction of frames where a worm was found,
+- centroid jitter: RMS of the frame-to-frame acceleration of the center (pixels), measured
+  within blocks of consecutive frames,
+- cost: mean time of detect_worm per frame (ms),
+- ROI fit (per square_size): fraction of detections whose bounding box fits in the ROI.
+
+The sampled frames are decoded once and cached as a .npy file, and the result of every
+combination is cached in a JSON file next to it, so re-running or extending a sweep only
+evaluates the new combinations. The best setting is written out as a JSON file in the
+tracking_tab_settings schema: the settings passed with --settings (saved from the tracking tab
+with Save Settings) with the best threshold, erode, dilate and square_size, or only those and
+brightfield when no settings were passed. Load Settings in
+the tracking tab applies it through update_tracking_settings; the calibration in the file is
+not applied, since it comes from the calibration cache of the rig.
+
+Usage:
+    python parameter_sweep.py recording.npy --settings tracking_settings.json --out best_settings.json
+
+"""
+
+import argparse
+import hashlib
+import itertools
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import cv2
+from binary_tracker import detect_worm
+from tracking_plan import compile_plan
+from roi_recorder import RoiRecording
+
+
+DEFAULT_GRID = {"threshold": [60, 80, 100, 120, 140],
+                "erode": [0, 1, 2],
+                "dilate": [0, 1, 2],
+                "square_size": [50, 75, 100, 150]}
+
+
+def _open_source(source):
+    """Returns an indexable sequence of frames from a .npy stack or a RoiRecorder folder."""
+    if os.path.isdir(source):
+        recording = RoiRecording(source)
+        return len(recording), recording.crop
+    frames = np.load(source, mmap_mode="r")
+    return len(frames), frames.__getitem__
+
+
+def sample_frames(source, n_blocks=20, block_length=10, cache_dir=None):
+    """
+    Decodes n_blocks blocks of block_length consecutive frames, spread evenly over the
+    recording, normalized to 8 bits like the live display. Returns the path of the cached stack
+    and the block length actually used (shorter when the recording is).
+    """
+    stat = os.stat(source)
+    key = f"{os.path.abspath(source)}|{stat.st_mtime}|{stat.st_size}|{n_blocks}|{block_length}"
+    digest = hashlib.sha1(key.encode()).hexdigest()[:16]
+    cache_dir = cache_dir or os.path.join(os.path.dirname(os.path.abspath(source)), "sweep_cache")
+    os.makedirs(cache_dir, exist_ok=True)
+    path = os.path.join(cache_dir, f"frames_{digest}.npy")
+    n_frames, get_frame = _open_source(source)
+    block_length = min(block_length, n_frames)
+    if os.path.isfile(path):
+        return path, block_length
+
+    starts = np.linspace(0, n_frames - block_length, n_blocks).astype(int)
+    frames = []
+    for start in np.unique(starts):
+        for i in range(start, start + block_length):
+            frames.append(cv2.normalize(np.asarray(get_frame(i)), None, 0, 255, cv2.NORM_MINMAX, dtype=cv2.CV_8U))
+    np.save(path, np.stack(frames))
+    return path, block_length
+
+
+def _evaluate(frames_path, block_length, settings, square_sizes):
+    """Worker: scores one (threshold, erode, dilate) combination for every square size."""
+    frames = np.load(frames_path, mmap_mode="r")
+    plan = compile_plan(settings)
+    centers = np.full((len(frames), 2), np.nan)
+    sizes = np.full((len(frames), 2), np.nan)
+    elapsed = 0.0
+    for i in range(len(frames)):
+        frame = np.array(frames[i])
+        start = time.perf_counter()
+        _, detection = detect_worm(plan, frame)
+        elapsed += time.perf_counter() - start
+        if detection is None:
+            continue
+        centers[i] = detection.center
+        # size of the worm's bounding box, to check which square sizes contain it
+        _, _, w, h = cv2.boundingRect(detection.contour)
+        sizes[i] = (w, h)
+
+    detected = ~np.isnan(centers[:, 0])
+    # second differences within each block of consecutive frames
+    blocks = centers.reshape(-1, block_length, 2)
+    acceleration = np.diff(blocks, n=2, axis=1).reshape(-1, 2)
+    acceleration = acceleration[~np.isnan(acceleration[:, 0])]
+    jitter = float(np.sqrt(np.mean(np.sum(acceleration ** 2, axis=1)))) if len(acceleration) else float("nan")
+
+    results = []
+    for square_size in square_sizes:
+        fits = np.all(sizes[detected] <= 2 * square_size, axis=1)
+        results.append({"square_size": square_size,
+                        "detection_rate": float(detected.mean()),
+                        "jitter_px": jitter,
+                        "cost_ms": 1000 * elapsed / len(frames),
+                        "roi_fit": float(fits.mean()) if len(fits) else 0.0})
+    return results
+
+
+def score(result, jitter_weight=0.01, cost_weight=0.01, min_roi_fit=0.99):
+    """Higher is better. ROIs that cut the worm off are rejected; among the others smaller ones win."""
+    if result["roi_fit"] < min_roi_fit or np.isnan(result["jitter_px"]):
+        return -np.inf
+    return (result["detection_rate"] - jitter_weight * result["jitter_px"]
+            - cost_weight * result["cost_ms"] - 1e-4 * result["square_size"])
+
+
+def run_sweep(source, base_settings, grid=None, n_blocks=20, block_length=10, cache_dir=None, max_workers=None):
+    """Runs the sweep and returns every result, best first. Cached results are reused."""
+    grid = dict(DEFAULT_GRID, **(grid or {}))
+    frames_path, block_length = sample_frames(source, n_blocks, block_length, cache_dir)
+    results_path = frames_path.replace("frames_", "results_").replace(".npy", ".json")
+    cached = {}
+    if os.path.isfile(results_path):
+        with open(results_path) as f:
+            cached = {entry["key"]: entry for entry in json.load(f)}
+
+    # the square size does not change the detection, so each worker covers all of them
+    todo = []
+    for threshold, erode, dilate in itertools.product(grid["threshold"], grid["erode"], grid["dilate"]):
+        settings = dict(base_settings, threshold=threshold, erode=erode, dilate=dilate)
+        missing = [size for size in grid["square_size"]
+                   if f"{settings['brightfield']}|{threshold}|{erode}|{dilate}|{size}" not in cached]
+        if missing:
+            todo.append((settings, missing))
+
+    if todo:
+        with ProcessPoolExecutor(max_workers=max_workers or os.cpu_count()) as pool:
+            futures = [(settings, pool.submit(_evaluate, frames_path, block_length, settings, missing))
+                       for settings, missing in todo]
+            for settings, future in futures:
+                for result in future.result():
+                    result.update(threshold=settings["threshold"], erode=settings["erode"],
+                                  dilate=settings["dilate"], brightfield=settings["brightfield"])
+                    result["key"] = (f"{settings['brightfield']}|{settings['threshold']}|{settings['erode']}|"
+                                     f"{settings['dilate']}|{result['square_size']}")
+                    cached[result["key"]] = result
+        with open(results_path, "w") as f:
+            json.dump(list(cached.values()), f, indent=1)
+
+    results = [entry for entry in cached.values()
+               if entry["brightfield"] == base_settings["brightfield"]
+               and entry["threshold"] in grid["threshold"] and entry["erode"] in grid["erode"]
+               and entry["dilate"] in grid["dilate"] and entry["square_size"] in grid["square_size"]]
+    return sorted(results, key=score, reverse=True)
+
+
+def save_settings(path, base_settings, result):
+    """Writes base_settings with the parameters of result, in the tracking_tab_settings schema."""
+    settings = dict(base_settings)
+    for key in ("threshold", "erode", "dilate", "square_size"):
+        settings[key] = result[key]
+    with open(path, "w") as f:
+        json.dump(settings, f, indent=2)
+    print(f"Saved settings to {path}")
+    return settings
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Sweep tracking parameters over a recording.")
+    parser.add_argument("source", help=".npy stack of frames or ROI recording folder")
+    parser.add_argument("--settings", help="JSON file with tracking_tab_settings to start from (Save Settings)")
+    parser.add_argument("--out", default="best_settings.json")
+    parser.add_argument("--darkfield", action="store_true", help="worm is brighter than the background")
+    args = parser.parse_args()
+
+    given = {}
+    if args.settings:
+        with open(args.settings) as f:
+            given = json.load(f)
+    if args.darkfield:
+        given["brightfield"] = False
+    # the defaults only make the plan compile; they are not written out, so loading the result
+    # never replaces settings the user did not pass
+    base_settings = dict({"threshold": 100, "square_size": 100, "erode": 1, "dilate": 1, "brightfield": True,
+                          "scale": 0.1, "xx": -20, "xy": 5, "yx": 5, "yy": -20, "gain": 10}, **given)
+
+    results = run_sweep(args.source, base_settings)
+    for result in results[:5]:
+        print(f"threshold={result['threshold']} erode={result['erode']} dilate={result['dilate']} "
+              f"square_size={result['square_size']}: detection {100 * result['detection_rate']:.1f}%, "
+              f"jitter {result['jitter_px']:.2f} px, {result['cost_ms']:.2f} ms/frame, "
+              f"ROI fit {100 * result['roi_fit']:.1f}%")
+    if results and np.isfinite(score(results[0])):
+        save_settings(args.out, dict(given, brightfield=base_settings["brightfield"]), results[0])
+    else:
+        print("No parameter combination tracked the worm reliably.")
+
+
+if __name__ == "__main__":
+    main()
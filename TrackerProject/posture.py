@@ -0,0 +1,283 @@
+"""
+posture: Midline, curvature and head/tail extraction from the tracking ROI
+
+binary_threshold only gives the center of the worm's bounding box. This module works on the
+square_size crop around that center: it binarizes the crop, keeps the largest object,
+skeletonizes it, orders the skeleton from one end to the other, resamples it to a fixed number
+of points and computes the curvature along the body.
+
+Key Features:
+- extract_posture processes a single frame and returns one fixed-width record.
+- PostureWorker runs extract_posture online in a background thread at a reduced rate.
+- process_recording runs it offline over a recorded stack of frames in a process pool.
+- PostureWriter / load_postures store the records as compact fixed-width binary files.
+
+The first point of the midline is the head. Head and tail cannot be told apart from a single
+mask, so the orientation is kept consistent from frame to frame (the head is the end closest
+to the previous head).
+
+"""
+
+import json
+import os
+import queue
+import threading
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import cv2
+from binary_tracker import binarize_frame, binary_threshold
+from tracking_plan import compile_plan
+
+
+def posture_dtype(n_points):
+    """Fixed-width record stored for every processed frame."""
+    return np.dtype([("frame", "<i8"),
+                     ("time", "<f8"),
+                     ("valid", "u1"),
+                     ("length", "<f4"),                      # midline length in pixels
+                     ("midline", "<f4", (n_points, 2)),     # (x, y) in frame coordinates, head first
+                     ("curvature", "<f4", (n_points,))])    # radians per pixel along the midline
+
+
+def _thin(mask):
+    """Skeletonizes a 0/255 mask. Uses OpenCV's thinning when opencv-contrib is installed."""
+    if hasattr(cv2, "ximgproc"):
+        return cv2.ximgproc.thinning(mask) > 0
+
+    # Zhang-Suen thinning, each sub-iteration done on the whole image at once
+    img = np.pad(mask > 0, 1).astype(np.uint8)
+    while True:
+        changed = False
+        for step in (0, 1):
+            p2, p3, p4 = img[:-2, 1:-1], img[:-2, 2:], img[1:-1, 2:]
+            p5, p6, p7 = img[2:, 2:], img[2:, 1:-1], img[2:, :-2]
+            p8, p9 = img[1:-1, :-2], img[:-2, :-2]
+            neighbours = [p2, p3, p4, p5, p6, p7, p8, p9, p2]
+            count = p2 + p3 + p4 + p5 + p6 + p7 + p8 + p9
+            transitions = sum((neighbours[i] == 0) & (neighbours[i + 1] == 1) for i in range(8))
+            if step == 0:
+                edge = (p2 * p4 * p6 == 0) & (p4 * p6 * p8 == 0)
+            else:
+                edge = (p2 * p4 * p8 == 0) & (p2 * p6 * p8 == 0)
+            remove = (img[1:-1, 1:-1] == 1) & (count >= 2) & (count <= 6) & (transitions == 1) & edge
+            if remove.any():
+                img[1:-1, 1:-1][remove] = 0
+                changed = True
+        if not changed:
+            return img[1:-1, 1:-1] > 0
+
+
+def _longest_path(skeleton):
+    """Returns the (row, col) pixels of the longest path through the skeleton, in order."""
+    pixels = np.argwhere(skeleton)
+    if len(pixels) < 2:
+        return None
+    index = {tuple(p): i for i, p in enumerate(pixels)}
+    offsets = [(-1, -1), (-1, 0), (-1, 1), (0, -1), (0, 1), (1, -1), (1, 0), (1, 1)]
+    neighbours = [[index[(r + dr, c + dc)] for dr, dc in offsets if (r + dr, c + dc) in index]
+                  for r, c in pixels]
+
+    def bfs(start):
+        parent = {start: None}
+        todo = deque([start])
+        last = start
+        while todo:
+            last = todo.popleft()
+            for n in neighbours[last]:
+                if n not in parent:
+                    parent[n] = last
+                    todo.append(n)
+        return last, parent
+
+    # the farthest pixel from anywhere is one end, the farthest pixel from that end is the other
+    end_a, _ = bfs(0)
+    end_b, parent = bfs(end_a)
+    path = []
+    node = end_b
+    while node is not None:
+        path.append(node)
+        node = parent[node]
+    return pixels[path]
+
+
+def _flip(record):
+    record["midline"] = record["midline"][::-1].copy()
+    record["curvature"] = -record["curvature"][::-1]
+
+
+def extract_posture(plan, frame, position, n_points=50, previous_head=None):
+    """
+    Returns a posture record (see posture_dtype) for the worm centered at position.
+    The frame and time fields are left to the caller.
+    """
+    record = np.zeros((), dtype=posture_dtype(n_points))
+    if position is None:
+        return record
+
+    # crop the square_size window around the worm, clipped at the frame edges
+    square_size = plan.square_size
+    x0, y0 = max(0, position[0] - square_size), max(0, position[1] - square_size)
+    crop = frame[y0:position[1] + square_size, x0:position[0] + square_size]
+    mask = binarize_frame(plan, crop)
+
+    # keep only the largest object so debris in the crop does not join the skeleton
+    n_labels, labels, stats, _ = cv2.connectedComponentsWithStats(mask, connectivity=8)
+    if n_labels < 2:
+        return record
+    largest = 1 + np.argmax(stats[1:, cv2.CC_STAT_AREA])
+    path = _longest_path(_thin(np.where(labels == largest, 255, 0).astype(np.uint8)))
+    if path is None:
+        return record
+
+    # resample the midline to n_points spaced evenly along its length
+    xy = path[:, ::-1].astype(np.float64) + (x0, y0)
+    arc = np.concatenate(([0.0], np.cumsum(np.hypot(*np.diff(xy, axis=0).T))))
+    samples = np.linspace(0, arc[-1], n_points)
+    midline = np.column_stack((np.interp(samples, arc, xy[:, 0]), np.interp(samples, arc, xy[:, 1])))
+
+    # curvature is the change of the tangent angle per pixel of midline
+    tangent = np.unwrap(np.arctan2(*np.gradient(midline, axis=0).T[::-1]))
+    spacing = arc[-1] / (n_points - 1)
+
+    record["valid"] = 1
+    record["length"] = arc[-1]
+    record["midline"] = midline
+    record["curvature"] = np.gradient(tangent) / spacing
+
+    if previous_head is not None:
+        head, tail = midline[0], midline[-1]
+        if np.hypot(*(tail - previous_head)) < np.hypot(*(head - previous_head)):
+            _flip(record)
+    return record
+
+
+class PostureWriter:
+    """
+    Appends posture records to a binary file. A small JSON file next to it stores the number
+    of midline points so load_postures can rebuild the record layout.
+    """
+    def __init__(self, path, n_points=50):
+        self.path = path
+        self.dtype = posture_dtype(n_points)
+        with open(path + ".json", "w") as f:
+            json.dump({"n_points": n_points, "dtype": str(self.dtype)}, f)
+        self.file = open(path, "wb")
+        self.records = 0
+
+    def write(self, records):
+        np.asarray(records, dtype=self.dtype).tofile(self.file)
+        self.records += np.size(records)
+
+    def close(self):
+        if not self.file.closed:
+            self.file.close()
+
+
+def load_postures(path, mmap=True):
+    """Loads a file written by PostureWriter as a structured array."""
+    with open(path + ".json") as f:
+        n_points = json.load(f)["n_points"]
+    if mmap:
+        return np.memmap(path, dtype=posture_dtype(n_points), mode="r")
+    return np.fromfile(path, dtype=posture_dtype(n_points))
+
+
+class PostureWorker:
+    """
+    Runs extract_posture online in a background thread. The tracking loop hands over every
+    Nth frame; if the worker is still busy with the previous one the new frame is skipped,
+    so posture extraction never slows down the control loop.
+    """
+    def __init__(self, path, every_n=5, n_points=50):
+        self.every_n = max(1, every_n)
+        self.n_points = n_points
+        self.writer = PostureWriter(path, n_points)
+        self.frames = queue.Queue(maxsize=1)
+        self.skipped = 0
+        self.last_record = None
+        self.thread = threading.Thread(target=self._run, name="PostureWorker", daemon=True)
+        self.thread.start()
+
+    def submit(self, plan, frame_index, timestamp, frame, position):
+        if frame_index % self.every_n != 0 or position is None:
+            return
+        # copy only the crop, the full frame is reused by the tracking loop
+        square_size = plan.square_size
+        x0, y0 = max(0, position[0] - square_size), max(0, position[1] - square_size)
+        crop = frame[y0:position[1] + square_size, x0:position[0] + square_size].copy()
+        try:
+            self.frames.put_nowait((plan, frame_index, timestamp, crop, (x0, y0), position))
+        except queue.Full:
+            self.skipped += 1
+
+    def _run(self):
+        previous_head = None
+        while True:
+            item = self.frames.get()
+            if item is None:
+                break
+            plan, frame_index, timestamp, crop, (x0, y0), position = item
+            record = extract_posture(plan, crop, (position[0] - x0, position[1] - y0),
+                                     self.n_points, None if previous_head is None else previous_head - (x0, y0))
+            if record["valid"]:
+                record["midline"] += (x0, y0)
+                previous_head = record["midline"][0].astype(np.float64)
+            record["frame"] = frame_index
+            record["time"] = timestamp
+            self.writer.write(record)
+            self.last_record = record
+
+    def stop(self):
+        self.frames.put(None)
+        self.thread.join()
+        self.writer.close()
+        print(f"Saved {self.writer.records} postures to {self.writer.path} ({self.skipped} frames skipped)")
+
+
+def _process_chunk(stack_path, tracking_tab_settings, start, stop, n_points):
+    """Worker of process_recording: extracts the postures of frames [start, stop) of a .npy stack."""
+    frames = np.load(stack_path, mmap_mode="r")
+    plan = compile_plan(tracking_tab_settings)
+    records = np.zeros(stop - start, dtype=posture_dtype(n_points))
+    previous_head = None
+    for i in range(start, stop):
+        frame = np.asarray(frames[i])
+        _, position = binary_threshold(plan, frame)
+        record = extract_posture(plan, frame, position, n_points, previous_head)
+        if record["valid"]:
+            previous_head = record["midline"][0].astype(np.float64)
+        record["frame"] = i
+        records[i - start] = record
+    return records
+
+
+def process_recording(stack_path, tracking_tab_settings, out_path, n_points=50,
+                      chunk_size=500, max_workers=None):
+    """
+    Extracts the posture of every frame of a recording saved as a (frames, height, width) .npy
+    stack, using a process pool. Chunks are written in order, and the head/tail orientation of
+    each chunk is matched to the end of the previous one.
+    """
+    n_frames = len(np.load(stack_path, mmap_mode="r"))
+    writer = PostureWriter(out_path, n_points)
+    previous_head = None
+    try:
+        with ProcessPoolExecutor(max_workers=max_workers or os.cpu_count()) as pool:
+            futures = [pool.submit(_process_chunk, stack_path, tracking_tab_settings,
+                                   start, min(start + chunk_size, n_frames), n_points)
+                       for start in range(0, n_frames, chunk_size)]
+            for future in futures:
+                records = future.result()
+                valid = np.flatnonzero(records["valid"])
+                if len(valid) > 0:
+                    if previous_head is not None:
+                        first = records[valid[0]]["midline"]
+                        if np.hypot(*(first[-1] - previous_head)) < np.hypot(*(first[0] - previous_head)):
+                            records["midline"][valid] = records["midline"][valid][:, ::-1]
+                            records["curvature"][valid] = -records["curvature"][valid][:, ::-1]
+                    previous_head = records[valid[-1]]["midline"][0].astype(np.float64)
+                writer.write(records)
+    finally:
+        writer.close()
+    return writer.records
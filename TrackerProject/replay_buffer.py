@@ -0,0 +1,86 @@
+"""
+ReplayBuffer: The last N processed frames, kept for instant replay
+
+When tracking is lost, the frames that explain why have already been overwritten in the live
+layer. This buffer keeps the last N frames of the tracking camera with their binary masks and
+detected centers. All arrays are allocated once when live starts, so memory is fixed for the
+session and adding a frame is two in-place copies.
+
+The frame and mask arrays are handed to napari as they are (no copy): slot i of the buffer is
+slice i of the layer, and the viewer's text overlay shows the sequence number of the slot
+being looked at. dump() writes the buffer to disk in chronological order.
+
+"""
+
+import numpy as np
+
+
+class ReplayBuffer:
+    def __init__(self, capacity, frame_shape, dtype=np.uint8):
+        self.capacity = max(1, capacity)
+        self.frame_shape = tuple(frame_shape)
+        self.frames = np.zeros((self.capacity,) + self.frame_shape, dtype=dtype)
+        self.masks = np.zeros((self.capacity,) + self.frame_shape, dtype=np.uint8)
+        self.detections = np.full((self.capacity, 2), np.nan, dtype=np.float32)
+        self.seq = np.full(self.capacity, -1, dtype=np.int64)
+        self.times = np.zeros(self.capacity, dtype=np.float64)
+        self.head = 0  # slot that will be written next
+        self.count = 0
+        self.rejected = 0  # frames whose shape did not match, e.g. after a binning change
+
+    def nbytes(self):
+        return self.frames.nbytes + self.masks.nbytes + self.detections.nbytes + self.seq.nbytes + self.times.nbytes
+
+    def push(self, frame, mask, position, seq, timestamp):
+        if frame.shape != self.frame_shape:
+            self.rejected += 1
+            return
+        slot = self.head
+        np.copyto(self.frames[slot], frame)
+        if mask is None:
+            self.masks[slot] = 0
+        else:
+            np.copyto(self.masks[slot], mask)
+        self.detections[slot] = position if position is not None else (np.nan, np.nan)
+        self.seq[slot] = seq
+        self.times[slot] = timestamp
+        self.head = (slot + 1) % self.capacity
+        self.count = min(self.count + 1, self.capacity)
+
+    def order(self):
+        """Slots from oldest to newest."""
+        return (np.arange(self.head - self.count, self.head) % self.capacity)
+
+    def show(self, viewer, layers=None):
+        """
+        Adds the buffer to a napari viewer as a frame layer and a mask layer that share the
+        buffer's memory, or refreshes the layers returned by a previous call.
+        """
+        if layers is None:
+            frames_layer = viewer.add_image(self.frames, name="Replay", colormap="gray")
+            masks_layer = viewer.add_image(self.masks, name="Replay Mask", colormap="red",
+                                           blending="additive", opacity=0.4)
+            viewer.dims.events.current_step.connect(lambda event: self._show_seq(viewer))
+            layers = (frames_layer, masks_layer)
+        else:
+            for layer in layers:
+                layer.refresh()
+        # start on the newest frame
+        newest = (self.head - 1) % self.capacity
+        viewer.dims.set_current_step(0, newest)
+        viewer.text_overlay.visible = True
+        self._show_seq(viewer)
+        return layers
+
+    def _show_seq(self, viewer):
+        slot = viewer.dims.current_step[0]
+        if 0 <= slot < self.capacity and self.seq[slot] >= 0:
+            age = (self.head - 1 - slot) % self.capacity
+            viewer.text_overlay.text = f"replay frame {self.seq[slot]} ({age} frames ago)"
+
+    def dump(self, path):
+        """Saves the buffered frames, masks and detections to a .npz file, oldest first."""
+        order = self.order()
+        np.savez(path, frames=self.frames[order], masks=self.masks[order], detections=self.detections[order],
+                 seq=self.seq[order], time=self.times[order])
+        print(f"Saved {len(order)} replay frames to {path}")
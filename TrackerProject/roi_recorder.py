@@ -0,0 +1,160 @@
+"""
+RoiRecorder: Recording only the tracking ROI instead of whole frames
+
+Most of every tracking frame is empty agar. In record mode we only store the square_size
+window around current_position, together with where that window was in the frame and where
+the stage was, which cuts the bytes written per frame by one to two orders of magnitude.
+
+Crops have a fixed shape (2 * square_size on each side; windows near the frame edge are
+shifted inwards rather than clipped) and are written into a folder of fixed-shape .npy chunks,
+each with a matching table of per-frame metadata. RoiRecording reads the folder back and can
+rebuild full frames or paste the crops in stage coordinates with RunwayMosaic.
+
+"""
+
+import json
+import os
+import numpy as np
+import cv2
+from runway_mosaic import RunwayMosaic
+
+
+META_DTYPE = np.dtype([("frame", "<i8"),
+                       ("time", "<f8"),
+                       ("x0", "<i4"),        # top-left corner of the crop in the frame
+                       ("y0", "<i4"),
+                       ("stage_x", "<f8"),
+                       ("stage_y", "<f8")])
+
+
+class RoiRecorder:
+    def __init__(self, directory, square_size, chunk_frames=1000):
+        self.directory = directory
+        # the chunks are numbered from roi_00000.npy, so an earlier recording would be overwritten
+        if os.path.isdir(directory) and os.listdir(directory):
+            raise FileExistsError(f"ROI recording folder {directory} is not empty.")
+        os.makedirs(directory, exist_ok=True)
+        self.crop_size = 2 * square_size
+        self.chunk_frames = chunk_frames
+        self.frame_shape = None
+        self.dtype = None
+        self.chunks = []
+        self.chunk = None
+        self.meta = np.zeros(chunk_frames, dtype=META_DTYPE)
+        self.index = 0  # position of the next crop in the current chunk
+        self.frames = 0
+        self.origin = None
+
+    def _crop_origin(self, position):
+        """Top-left corner of the crop, kept inside the frame so every crop has the same shape."""
+        height, width = self.frame_shape
+        if position is None:
+            # keep recording the last window while the worm is lost
+            if self.origin is not None:
+                return self.origin
+            position = (width // 2, height // 2)
+        half = self.crop_size // 2
+        x0 = min(max(0, position[0] - half), max(0, width - self.crop_size))
+        y0 = min(max(0, position[1] - half), max(0, height - self.crop_size))
+        return int(x0), int(y0)
+
+    def _open_chunk(self):
+        name = f"roi_{len(self.chunks):05d}.npy"
+        self.chunks.append(name)
+        self.chunk = np.lib.format.open_memmap(os.path.join(self.directory, name), mode="w+", dtype=self.dtype,
+                                               shape=(self.chunk_frames, self.crop_size, self.crop_size))
+        self.index = 0
+
+    def _close_chunk(self):
+        name = self.chunks[-1]
+        path = os.path.join(self.directory, name)
+        self.chunk.flush()
+        if self.index < self.chunk_frames:
+            # the last chunk is trimmed so the folder holds no empty frames
+            crops = np.array(self.chunk[:self.index])
+            del self.chunk
+            np.save(path, crops)
+        np.save(os.path.join(self.directory, name.replace("roi_", "meta_")), self.meta[:self.index])
+        self.chunk = None
+
+    def write(self, frame, position, stage_xy, timestamp, frame_index):
+        if self.frame_shape is None:
+            self.frame_shape = frame.shape[:2]
+            self.dtype = frame.dtype
+        if self.chunk is None:
+            self._open_chunk()
+
+        x0, y0 = self.origin = self._crop_origin(position)
+        crop = frame[y0:y0 + self.crop_size, x0:x0 + self.crop_size]
+        target = self.chunk[self.index]
+        if crop.shape != target.shape:
+            # only happens when the frame is smaller than the crop
+            target[:] = 0
+            target = target[:crop.shape[0], :crop.shape[1]]
+        target[:] = crop
+        self.meta[self.index] = (frame_index, timestamp, x0, y0, stage_xy[0], stage_xy[1])
+
+        self.index += 1
+        self.frames += 1
+        if self.index == self.chunk_frames:
+            self._close_chunk()
+
+    def close(self):
+        if self.chunk is not None:
+            self._close_chunk()
+        with open(os.path.join(self.directory, "index.json"), "w") as f:
+            json.dump({"frames": self.frames,
+                       "crop_size": self.crop_size,
+                       "frame_shape": list(self.frame_shape) if self.frame_shape else None,
+                       "dtype": str(self.dtype),
+                       "chunks": self.chunks}, f)
+        print(f"Saved {self.frames} ROI frames to {self.directory}")
+
+
+class RoiRecording:
+    """Reads a folder written by RoiRecorder. Crops are memory-mapped, one chunk at a time."""
+    def __init__(self, directory):
+        self.directory = directory
+        with open(os.path.join(directory, "index.json")) as f:
+            index = json.load(f)
+        self.frame_shape = tuple(index["frame_shape"])
+        self.crop_size = index["crop_size"]
+        self.chunks = index["chunks"]
+        metas = [np.load(os.path.join(directory, name.replace("roi_", "meta_"))) for name in self.chunks]
+        self.meta = np.concatenate(metas) if metas else np.zeros(0, META_DTYPE)
+        # index of the first frame of every chunk
+        self.starts = np.cumsum([0] + [len(meta) for meta in metas])
+        self._chunk_number = None
+        self._chunk = None
+
+    def __len__(self):
+        return len(self.meta)
+
+    def crop(self, i):
+        chunk_number = int(np.searchsorted(self.starts, i, side="right") - 1)
+        if chunk_number != self._chunk_number:
+            self._chunk = np.load(os.path.join(self.directory, self.chunks[chunk_number]), mmap_mode="r")
+            self._chunk_number = chunk_number
+        return self._chunk[i - self.starts[chunk_number]]
+
+    def full_frame(self, i, fill=0):
+        """Rebuilds frame i with the crop at its original place and fill everywhere else."""
+        crop = self.crop(i)
+        frame = np.full(self.frame_shape, fill, dtype=crop.dtype)
+        x0, y0 = self.meta["x0"][i], self.meta["y0"][i]
+        height, width = min(crop.shape[0], self.frame_shape[0] - y0), min(crop.shape[1], self.frame_shape[1] - x0)
+        frame[y0:y0 + height, x0:x0 + width] = crop[:height, :width]
+        return frame
+
+    def stage_view(self, plan, um_per_pixel=5.0, every_n=1):
+        """Pastes the crops at their stage positions and returns a RunwayMosaic of the recording."""
+        mosaic = RunwayMosaic(um_per_pixel=um_per_pixel)
+        mosaic.stop()  # crops are pasted here rather than in the mosaic's background thread
+        for i in range(0, len(self), every_n):
+            crop = self.crop(i)
+            if crop.dtype != np.uint8:
+                crop = cv2.normalize(np.asarray(crop), None, 0, 255, cv2.NORM_MINMAX, dtype=cv2.CV_8U)
+            meta = self.meta[i]
+            mosaic.paste(plan, crop, (meta["stage_x"], meta["stage_y"]),
+                         origin=(meta["x0"], meta["y0"]), frame_shape=self.frame_shape)
+        return mosaic
@@ -0,0 +1,173 @@
+"""
+RunwayMosaic: Low-resolution map of the plate explored by the worm
+
+Every Nth tracked frame is downsampled and pasted at its stage position into a canvas in
+stage coordinates, so we can see where the worm has been during a session. The canvas is
+split into square tiles that are only allocated when a frame lands on them, and the number
+of tiles is capped: when the cap is reached the least recently updated tile is dropped.
+Tiles far apart still span a large bounding box, so the image built for display and export is
+downsampled until it fits in max_pixels.
+
+Frames are placed with the same pixel_to_stage conversion used by update_vectors and
+trajectory_analysis, so a pixel at offset d from the center of the frame is drawn at
+stage_xy - pixel_to_stage(d). Pasting happens in a background thread; submit() never waits,
+so the mosaic cannot slow down the control loop.
+
+"""
+
+import json
+import queue
+import threading
+from collections import OrderedDict
+import numpy as np
+import cv2
+from binary_tracker import pixel_to_stage
+
+
+class RunwayMosaic:
+    def __init__(self, um_per_pixel=20.0, tile_size=512, max_tiles=256, every_n=5):
+        self.um_per_pixel = float(um_per_pixel)  # resolution of the mosaic
+        self.tile_size = tile_size
+        self.max_tiles = max_tiles
+        self.every_n = max(1, every_n)
+        self.tiles = OrderedDict()  # (tile_x, tile_y) -> uint8 array, most recently updated last
+        self.evicted_tiles = 0
+        self.skipped_frames = 0
+        self.version = 0  # increases every time a frame is pasted, so viewers know when to refresh
+        self.lock = threading.Lock()
+        self.frames = queue.Queue(maxsize=2)
+        self.thread = threading.Thread(target=self._run, name="RunwayMosaic", daemon=True)
+        self.thread.start()
+
+    def submit(self, plan, frame, stage_xy):
+        """Queues an 8-bit frame taken at stage_xy (um). Drops it if the worker is busy."""
+        try:
+            self.frames.put_nowait((plan, frame, stage_xy))
+        except queue.Full:
+            self.skipped_frames += 1
+
+    def _run(self):
+        while True:
+            item = self.frames.get()
+            if item is None:
+                break
+            self.paste(*item)
+
+    def _frame_to_mosaic(self, plan, frame_shape, stage_xy, origin=(0, 0)):
+        """
+        Affine matrix (2x3) mapping pixels (x, y) of an image to mosaic pixels. The image is
+        either a whole frame of frame_shape, or a crop of it whose top-left pixel is at origin.
+        """
+        height, width = frame_shape[:2]
+        # columns of the 2x2 matrix are the stage displacement of one pixel along x and along y
+        linear = -np.array(pixel_to_stage(plan, np.array([1.0, 0.0]), np.array([0.0, 1.0])))
+        linear /= self.um_per_pixel
+        center = np.array([width / 2, height / 2])
+        offset = np.asarray(stage_xy, dtype=np.float64) / self.um_per_pixel + linear @ (np.asarray(origin) - center)
+        return np.column_stack((linear, offset))
+
+    def paste(self, plan, frame, stage_xy, origin=(0, 0), frame_shape=None):
+        """
+        Downsamples frame and pastes it into the tiles it overlaps. To paste a crop, pass the
+        position of its top-left pixel in the full frame as origin and the full frame's shape.
+        """
+        if frame_shape is None:
+            frame_shape = frame.shape
+        matrix = self._frame_to_mosaic(plan, frame_shape, stage_xy, origin)
+
+        # shrink the frame first so warpAffine does not alias when the mosaic is much coarser
+        shrink = np.sqrt(abs(np.linalg.det(matrix[:, :2])))
+        if 0 < shrink < 1:
+            frame = cv2.resize(frame, None, fx=shrink, fy=shrink, interpolation=cv2.INTER_AREA)
+            matrix[:, :2] /= shrink
+
+        # bounding box of the warped frame in mosaic pixels
+        height, width = frame.shape[:2]
+        corners = matrix @ np.array([[0, width, 0, width], [0, 0, height, height], [1, 1, 1, 1]])
+        x0, y0 = np.floor(corners.min(axis=1)).astype(int)
+        x1, y1 = np.ceil(corners.max(axis=1)).astype(int)
+        if x1 <= x0 or y1 <= y0:
+            return
+
+        local = matrix.copy()
+        local[:, 2] -= (x0, y0)
+        patch = cv2.warpAffine(frame, local, (x1 - x0, y1 - y0), flags=cv2.INTER_LINEAR)
+        valid = cv2.warpAffine(np.full(frame.shape[:2], 255, np.uint8), local, (x1 - x0, y1 - y0),
+                               flags=cv2.INTER_NEAREST) > 0
+
+        size = self.tile_size
+        with self.lock:
+            for tile_y in range(y0 // size, (y1 - 1) // size + 1):
+                for tile_x in range(x0 // size, (x1 - 1) // size + 1):
+                    tile = self._get_tile((tile_x, tile_y))
+                    # overlap of the patch with this tile, in mosaic pixels
+                    ox0, oy0 = max(x0, tile_x * size), max(y0, tile_y * size)
+                    ox1, oy1 = min(x1, (tile_x + 1) * size), min(y1, (tile_y + 1) * size)
+                    source = (slice(oy0 - y0, oy1 - y0), slice(ox0 - x0, ox1 - x0))
+                    target = tile[oy0 - tile_y * size:oy1 - tile_y * size, ox0 - tile_x * size:ox1 - tile_x * size]
+                    np.copyto(target, patch[source], where=valid[source])
+            self.version += 1
+
+    def _get_tile(self, key):
+        tile = self.tiles.get(key)
+        if tile is None:
+            if len(self.tiles) >= self.max_tiles:
+                self.tiles.popitem(last=False)
+                self.evicted_tiles += 1
+            tile = np.zeros((self.tile_size, self.tile_size), np.uint8)
+            self.tiles[key] = tile
+        else:
+            self.tiles.move_to_end(key)
+        return tile
+
+    def to_array(self, max_pixels=8192 * 8192):
+        """
+        Returns the mosaic as one image, the stage position (x, y in um) of its top-left pixel and
+        its resolution in um per pixel. Tiles are shrunk by the smallest divisor of tile_size that
+        keeps the image within max_pixels.
+        """
+        with self.lock:
+            if not self.tiles:
+                return np.zeros((1, 1), np.uint8), (0.0, 0.0), self.um_per_pixel
+            keys = np.array(list(self.tiles.keys()))
+            tx0, ty0 = keys.min(axis=0)
+            tx1, ty1 = keys.max(axis=0) + 1
+            full_pixels = (ty1 - ty0) * (tx1 - tx0) * self.tile_size ** 2
+            step = next((step for step in range(1, self.tile_size + 1)
+                         if self.tile_size % step == 0 and full_pixels / step ** 2 <= max_pixels), self.tile_size)
+            size = self.tile_size // step
+            image = np.zeros(((ty1 - ty0) * size, (tx1 - tx0) * size), np.uint8)
+            for (tile_x, tile_y), tile in self.tiles.items():
+                if step > 1:
+                    tile = cv2.resize(tile, (size, size), interpolation=cv2.INTER_AREA)
+                y = (tile_y - ty0) * size
+                x = (tile_x - tx0) * size
+                image[y:y + size, x:x + size] = tile
+        origin = (tx0 * self.tile_size * self.um_per_pixel, ty0 * self.tile_size * self.um_per_pixel)
+        return image, origin, self.um_per_pixel * step
+
+    def show(self, viewer, layer=None):
+        """Adds the mosaic to a napari viewer, or updates the layer returned by a previous call."""
+        image, (origin_x, origin_y), um_per_pixel = self.to_array()
+        if layer is None:
+            layer = viewer.add_image(image, name="Runway Mosaic", colormap="gray",
+                                     scale=(um_per_pixel, um_per_pixel))
+        else:
+            layer.data = image
+            layer.scale = (um_per_pixel, um_per_pixel)
+        # napari uses (row, column) i.e. (y, x) order
+        layer.translate = (origin_y, origin_x)
+        return layer
+
+    def export(self, path):
+        """Saves the mosaic as a PNG image with a JSON file describing its stage coordinates."""
+        image, origin, um_per_pixel = self.to_array()
+        cv2.imwrite(path, image)
+        with open(path + ".json", "w") as f:
+            json.dump({"origin_um": origin, "um_per_pixel": um_per_pixel,
+                       "evicted_tiles": self.evicted_tiles}, f)
+        print(f"Saved runway mosaic to {path}")
+
+    def stop(self):
+        self.frames.put(None)
+        self.thread.join()
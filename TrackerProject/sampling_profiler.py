@@ -0,0 +1,90 @@
+"""
+SamplingProfiler: A statistical profile of the running tracker, captured on demand
+
+Running the GUI under cProfile slows down every function call, which changes the timing we are
+trying to measure. Instead, a background thread looks at the call stack of every other thread
+(the Qt/napari main thread with the live loops, and the workers: posture, mosaic, Z mover, ...)
+a few hundred times per second for a fixed duration, and counts how often each stack is seen.
+The running code is not instrumented, so the loop runs at its normal speed while profiling.
+
+The result is saved in the "collapsed stack" format (one line per stack, frames separated by
+semicolons, followed by the number of samples), which can be opened in speedscope
+(https://www.speedscope.app) or turned into a flame graph with flamegraph.pl. The first frame of
+every stack is the thread name, so each thread appears as its own tower. The tracking settings
+active during the capture are saved next to it.
+
+"""
+
+import collections
+import json
+import os
+import sys
+import threading
+import time
+
+
+def _collapse(frame, thread_name):
+    stack = []
+    while frame is not None:
+        code = frame.f_code
+        stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+        frame = frame.f_back
+    stack.append(thread_name)
+    return ";".join(reversed(stack))
+
+
+class SamplingProfiler:
+    def __init__(self, duration=10.0, interval=0.005):
+        self.duration = duration
+        self.interval = interval  # seconds between samples
+        self.samples = collections.Counter()
+        self.n_samples = 0
+        self.thread = None
+
+    def running(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    def start(self, path, settings=None):
+        """
+        Samples all threads for self.duration seconds in the background, then writes the profile
+        to path (collapsed stacks) and settings to a .json file with the same name.
+        """
+        if self.running():
+            print("A profile is already being captured.")
+            return False
+        self.samples.clear()
+        self.n_samples = 0
+        self.thread = threading.Thread(target=self._run, args=(path, dict(settings or {})),
+                                       name="SamplingProfiler", daemon=True)
+        self.thread.start()
+        return True
+
+    def _sample(self):
+        own_id = threading.get_ident()
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id != own_id:
+                self.samples[_collapse(frame, names.get(thread_id, f"thread-{thread_id}"))] += 1
+        self.n_samples += 1
+
+    def _run(self, path, settings):
+        start = time.perf_counter()
+        next_sample = start
+        while next_sample - start < self.duration:
+            self._sample()
+            next_sample += self.interval
+            time.sleep(max(0.0, next_sample - time.perf_counter()))
+        elapsed = time.perf_counter() - start
+        self.save(path, settings, elapsed)
+
+    def save(self, path, settings, elapsed):
+        with open(path, "w") as f:
+            for stack, count in self.samples.most_common():
+                f.write(f"{stack} {count}\n")
+        info = {"duration_s": elapsed,
+                "samples": self.n_samples,
+                "interval_s": self.interval,
+                "tracking_tab_settings": settings}
+        with open(os.path.splitext(path)[0] + ".json", "w") as f:
+            json.dump(info, f, indent=2, default=str)
+        print(f"Saved profile of {self.n_samples} samples over {elapsed:.1f} s to {path}")
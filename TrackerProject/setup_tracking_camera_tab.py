@@ -2,16 +2,28 @@ import napari
 from PyQt5.QtGui import QIntValidator, QDoubleValidator
 from PyQt5.QtWidgets import (QGridLayout,
                              QGroupBox, QFormLayout,
-                             QLineEdit, QCheckBox, QComboBox, QPushButton)
-from PyQt5.QtWidgets import QWidget
+                             QLineEdit, QCheckBox, QComboBox, QPushButton, QLabel)
+from PyQt5.QtWidgets import QWidget, QFileDialog
+from PyQt5.QtCore import pyqtSignal
 import time
 from img_handling_functions import *
+from runway_mosaic import RunwayMosaic
+from multi_worm_tracker import MultiWormTracker
+from frame_source import FRAME_POLICIES
+from autofocus import FocusTracker
+from replay_buffer import ReplayBuffer
+from sampling_profiler import SamplingProfiler
+from mda_recording import MdaRecorder
+from tracking_overlay import TrackingOverlay
 
 """
 In the Tracking Camera tab, you can place controls
 specific to the tracking camera.
 """
 class setup_tracking_camera_tab(QWidget):
+    # emitted when another calibration was loaded or measured, so its status can be shown
+    calibration_changed = pyqtSignal()
+
     def __init__(self, camera_manager = None):
         super().__init__()
         # Initialize tracking_settings dictionary where
@@ -22,6 +34,10 @@ class setup_tracking_camera_tab(QWidget):
             raise ValueError("Error: `camera_manager` must be initialized before creating `setup_tracking_camera_tab`.")
         self.tracking_tab_settings = camera_manager.tracking_tab_settings
         self.recording_tab_settings = camera_manager.recording_tab_settings
+        self.viewer = None
+        self.mosaic_layer = None
+        self.replay_layers = None
+        self.profiler = SamplingProfiler(duration=10)
 
         # generate validators for user inputs
         int_validator = QIntValidator()
@@ -42,12 +58,17 @@ class setup_tracking_camera_tab(QWidget):
         self.exposure_input = QLineEdit()
         self.fps_input = QLineEdit()
         self.binning_input = QComboBox()
+        self.frame_policy_input = QComboBox()
+        self.every_n_frames_input = QLineEdit()
 
         # Set default values
         self.exposure_input.setText(str(self.tracking_tab_settings["exposure"]))
         self.fps_input.setText(str(self.tracking_tab_settings["fps"]))
         self.binning_input.addItems(["2x2", "4x4"])
         self.binning_input.setCurrentText(self.tracking_tab_settings["binning"])
+        self.frame_policy_input.addItems(FRAME_POLICIES)
+        self.frame_policy_input.setCurrentText(self.tracking_tab_settings["frame_policy"])
+        self.every_n_frames_input.setText(str(self.tracking_tab_settings["every_n_frames"]))
 
         # set integer validator so that user can only inout number
         self.exposure_input.setValidator(int_validator)
@@ -57,14 +78,26 @@ class setup_tracking_camera_tab(QWidget):
         tracking_settings_layout.addRow("Exposure (ms):", self.exposure_input)
         tracking_settings_layout.addRow("FPS:", self.fps_input)
         tracking_settings_layout.addRow("Binning:", self.binning_input)
+        tracking_settings_layout.addRow("Frame policy:", self.frame_policy_input)
+        tracking_settings_layout.addRow("Every N frames:", self.every_n_frames_input)
 
-        #Directly update the dictionary using `connect()`
-        self.exposure_input.textChanged.connect(lambda: self.tracking_tab_settings.update(
+        # Update the settings (and rebuild the tracking plan) using `connect()`
+        self.exposure_input.textChanged.connect(lambda: self.camera_manager.update_tracking_settings(
             {"exposure": int(self.exposure_input.text()) if self.exposure_input.text().isdigit() else 0}))
-        self.fps_input.textChanged.connect(lambda: self.tracking_tab_settings.update(
+        self.fps_input.textChanged.connect(lambda: self.camera_manager.update_tracking_settings(
             {"fps": int(self.fps_input.text()) if self.fps_input.text().isdigit() else 0}))
-        self.binning_input.currentTextChanged.connect(
-            lambda: self.tracking_tab_settings.update({"binning": self.binning_input.currentText()}))
+        self.binning_input.currentTextChanged.connect(self.update_binning)
+        self.frame_policy_input.currentTextChanged.connect(
+            lambda: self.camera_manager.update_tracking_settings({"frame_policy": self.frame_policy_input.currentText()}))
+        self.every_n_frames_input.textChanged.connect(lambda: self.camera_manager.update_tracking_settings(
+            {"every_n_frames": int(self.every_n_frames_input.text()) if self.every_n_frames_input.text().isdigit() else 1}))
+
+        # live frame counts of each camera, refreshed once per second
+        self.frame_stats_label = QLabel("Frames: (not live)")
+        tracking_settings_layout.addRow(self.frame_stats_label)
+        self.frame_stats_timer = QTimer()
+        self.frame_stats_timer.timeout.connect(self.update_frame_stats)
+        self.frame_stats_timer.start(1000)
 
         tracking_settings_group.setLayout(tracking_settings_layout)
 
@@ -86,8 +119,15 @@ class setup_tracking_camera_tab(QWidget):
         self.erode_input = QLineEdit()
         self.dilate_input = QLineEdit()
         self.max_runway_input = QLineEdit()
+        self.posture_every_n_input = QLineEdit()
         self.brightfield_checkbox = QCheckBox("Brightfield?")
         self.save_stage_positions_checkbox = QCheckBox("Save Stage Positions?")
+        self.stage_motion_checkbox = QCheckBox("Move Stage?")
+        self.multi_worm_checkbox = QCheckBox("Track All Worms?")
+        self.min_blob_area_input = QLineEdit()
+        self.autofocus_checkbox = QCheckBox("Track Focus?")
+        self.publish_frames_checkbox = QCheckBox("Publish Frames?")
+        self.shared_memory_name_input = QLineEdit()
 
         #populate the boxes we just created
         print("populating tracking settings")
@@ -102,31 +142,54 @@ class setup_tracking_camera_tab(QWidget):
         self.yx_input.setText(str(self.tracking_tab_settings["yx"]))
         self.yy_input.setText(str(self.tracking_tab_settings["yy"]))
         self.gain_input.setText(str(self.tracking_tab_settings["gain"]))
+        self.posture_every_n_input.setText(str(self.tracking_tab_settings["posture_every_n"]))
+        self.min_blob_area_input.setText(str(self.tracking_tab_settings["min_blob_area"]))
 
         print("validating tracking settings")
         # apply the integer validator to ensure the user input values are numbers
-        self.scale_input.textChanged.connect(lambda: self.tracking_tab_settings.update(
+        self.scale_input.textChanged.connect(lambda: self.camera_manager.update_tracking_settings(
             {"scale": int(self.scale_input.text()) if self.scale_input.text().isdigit() else 0}))
-        self.threshold_input.textChanged.connect(lambda: self.tracking_tab_settings.update(
+        self.threshold_input.textChanged.connect(lambda: self.camera_manager.update_tracking_settings(
             {"threshold": int(self.threshold_input.text()) if self.threshold_input.text().isdigit() else 0}))
-        self.square_size_input.textChanged.connect(lambda: self.tracking_tab_settings.update(
+        self.square_size_input.textChanged.connect(lambda: self.camera_manager.update_tracking_settings(
             {"square_size": int(self.square_size_input.text()) if self.square_size_input.text().isdigit() else 0}))
-        self.erode_input.textChanged.connect(lambda: self.tracking_tab_settings.update(
+        self.erode_input.textChanged.connect(lambda: self.camera_manager.update_tracking_settings(
             {"erode": int(self.erode_input.text()) if self.erode_input.text().isdigit() else 0}))
-        self.dilate_input.textChanged.connect(lambda: self.tracking_tab_settings.update(
+        self.dilate_input.textChanged.connect(lambda: self.camera_manager.update_tracking_settings(
             {"dilate": int(self.dilate_input.text()) if self.dilate_input.text().isdigit() else 0}))
-        self.max_runway_input.textChanged.connect(lambda: self.tracking_tab_settings.update(
+        self.max_runway_input.textChanged.connect(lambda: self.camera_manager.update_tracking_settings(
             {"max_runway": int(self.max_runway_input.text()) if self.max_runway_input.text().isdigit() else 0}))
-        self.xx_input.textChanged.connect(lambda: self.tracking_tab_settings.update(
+        self.xx_input.textChanged.connect(lambda: self.camera_manager.update_tracking_settings(
             {"xx": int(self.xx_input.text()) if self.xx_input.text().isdigit() else 0}))
-        self.xy_input.textChanged.connect(lambda: self.tracking_tab_settings.update(
+        self.xy_input.textChanged.connect(lambda: self.camera_manager.update_tracking_settings(
             {"xy": int(self.xy_input.text()) if self.xy_input.text().isdigit() else 0}))
-        self.yx_input.textChanged.connect(lambda: self.tracking_tab_settings.update(
+        self.yx_input.textChanged.connect(lambda: self.camera_manager.update_tracking_settings(
             {"yx": int(self.yx_input.text()) if self.yx_input.text().isdigit() else 0}))
-        self.yy_input.textChanged.connect(lambda: self.tracking_tab_settings.update(
+        self.yy_input.textChanged.connect(lambda: self.camera_manager.update_tracking_settings(
             {"yy": int(self.yy_input.text()) if self.yy_input.text().isdigit() else 0}))
-        self.gain_input.textChanged.connect(lambda: self.tracking_tab_settings.update(
+        self.gain_input.textChanged.connect(lambda: self.camera_manager.update_tracking_settings(
             {"gain": int(self.gain_input.text()) if self.gain_input.text().isdigit() else 0}))
+        self.posture_every_n_input.textChanged.connect(lambda: self.camera_manager.update_tracking_settings(
+            {"posture_every_n": int(self.posture_every_n_input.text()) if self.posture_every_n_input.text().isdigit() else 0}))
+        self.min_blob_area_input.textChanged.connect(lambda: self.camera_manager.update_tracking_settings(
+            {"min_blob_area": int(self.min_blob_area_input.text()) if self.min_blob_area_input.text().isdigit() else 0}))
+        self.multi_worm_checkbox.setChecked(self.tracking_tab_settings["multi_worm"])
+        self.multi_worm_checkbox.stateChanged.connect(self.update_multi_worm)
+        self.autofocus_checkbox.setChecked(self.tracking_tab_settings["autofocus"])
+        self.autofocus_checkbox.stateChanged.connect(self.update_autofocus)
+        self.save_stage_positions_checkbox.setChecked(self.tracking_tab_settings["Save_stage_positions"])
+        self.save_stage_positions_checkbox.stateChanged.connect(lambda: self.camera_manager.update_tracking_settings(
+            {"Save_stage_positions": self.save_stage_positions_checkbox.isChecked()}))
+        # the stage only follows the worm when this is checked; moves stay within Max Runway
+        # other programs can read the live frames from shared memory under this name, see frame_publisher
+        self.shared_memory_name_input.setText(self.tracking_tab_settings["shared_memory_name"])
+        self.shared_memory_name_input.textChanged.connect(lambda: self.camera_manager.update_tracking_settings(
+            {"shared_memory_name": self.shared_memory_name_input.text().strip()}))
+        self.publish_frames_checkbox.setChecked(self.tracking_tab_settings["publish_frames"])
+        self.publish_frames_checkbox.stateChanged.connect(self.update_publishing)
+        self.stage_motion_checkbox.setChecked(self.tracking_tab_settings["stage_motion"])
+        self.stage_motion_checkbox.stateChanged.connect(lambda: self.camera_manager.update_tracking_settings(
+            {"stage_motion": self.stage_motion_checkbox.isChecked()}))
 
         print("adding rows onto layout")
         #add all widgets onto the layout. we only add rows since we are using form-layout.
@@ -143,8 +206,15 @@ class setup_tracking_camera_tab(QWidget):
         tracking_params_layout.addRow("Erode:", self.erode_input)
         tracking_params_layout.addRow("Dilate:", self.dilate_input)
         tracking_params_layout.addRow("Max Runway (µm):", self.max_runway_input)
+        tracking_params_layout.addRow(self.stage_motion_checkbox)
+        tracking_params_layout.addRow("Posture every N frames (0 = off):", self.posture_every_n_input)
         tracking_params_layout.addRow(self.brightfield_checkbox)
         tracking_params_layout.addRow(self.save_stage_positions_checkbox)
+        tracking_params_layout.addRow("Min Worm Area (pixels):", self.min_blob_area_input)
+        tracking_params_layout.addRow(self.multi_worm_checkbox)
+        tracking_params_layout.addRow(self.autofocus_checkbox)
+        tracking_params_layout.addRow("Shared Memory Name:", self.shared_memory_name_input)
+        tracking_params_layout.addRow(self.publish_frames_checkbox)
 
         print("setting layout")
         # set the layout we designed above
@@ -161,6 +231,13 @@ class setup_tracking_camera_tab(QWidget):
         self.track_button = QPushButton("Track")
         self.record_button = QPushButton("Record")
         self.stop_button = QPushButton("Stop")
+        self.mosaic_button = QPushButton("Show Mosaic")
+        self.replay_button = QPushButton("Show Replay")
+        self.dump_replay_button = QPushButton("Dump Replay")
+        self.profile_button = QPushButton("Profile 10 s")
+        self.mda_button = QPushButton("Record (MDA)")
+        self.save_settings_button = QPushButton("Save Settings")
+        self.load_settings_button = QPushButton("Load Settings")
 
         # Enable toggle mode
         self.prepare_button.setCheckable(True)
@@ -174,12 +251,26 @@ class setup_tracking_camera_tab(QWidget):
         self.track_button.clicked.connect(self.update_tracking_state)
         self.record_button.clicked.connect(self.update_tracking_state)
         self.stop_button.clicked.connect(self.update_tracking_state)
+        self.mosaic_button.clicked.connect(self.show_mosaic)
+        self.replay_button.clicked.connect(self.show_replay)
+        self.dump_replay_button.clicked.connect(self.dump_replay)
+        self.profile_button.clicked.connect(self.start_profile)
+        self.mda_button.clicked.connect(self.toggle_mda_recording)
+        self.save_settings_button.clicked.connect(self.save_settings)
+        self.load_settings_button.clicked.connect(self.load_settings)
 
         tracking_buttons_layout.addRow(self.live_button)
         tracking_buttons_layout.addRow(self.prepare_button)
         tracking_buttons_layout.addRow(self.track_button)
         tracking_buttons_layout.addRow(self.record_button)
         tracking_buttons_layout.addRow(self.stop_button)
+        tracking_buttons_layout.addRow(self.mosaic_button)
+        tracking_buttons_layout.addRow(self.replay_button)
+        tracking_buttons_layout.addRow(self.dump_replay_button)
+        tracking_buttons_layout.addRow(self.profile_button)
+        tracking_buttons_layout.addRow(self.mda_button)
+        tracking_buttons_layout.addRow(self.save_settings_button)
+        tracking_buttons_layout.addRow(self.load_settings_button)
 
         tracking_buttons_group.setLayout(tracking_buttons_layout)
 
@@ -196,19 +287,68 @@ class setup_tracking_camera_tab(QWidget):
         """ Updates camera manager after GUI initialization """
         self.camera_manager = camera_manager
 
+    def update_binning(self):
+        # the calibration is cached per binning, so changing it can load another calibration
+        self.camera_manager.update_tracking_settings({"binning": self.binning_input.currentText()})
+        self.refresh_calibration_inputs()
+
+    def run_calibration(self):
+        run_calibration(self.camera_manager)
+        self.refresh_calibration_inputs()
+
+    def refresh_calibration_inputs(self):
+        """Shows the calibration in use after it was loaded from the cache or measured."""
+        for key, field in (("scale", self.scale_input), ("xx", self.xx_input), ("xy", self.xy_input),
+                           ("yx", self.yx_input), ("yy", self.yy_input)):
+            # the fields' handlers would write their text back into the settings as integers
+            field.blockSignals(True)
+            field.setText(str(self.tracking_tab_settings[key]))
+            field.blockSignals(False)
+        self.calibration_changed.emit()
+
+    def save_settings(self):
+        path, _ = QFileDialog.getSaveFileName(self, "Save Tracking Settings", "tracking_settings.json",
+                                              "Settings (*.json)")
+        if path:
+            self.camera_manager.save_tracking_settings(path)
+
+    def load_settings(self):
+        """Applies a settings file, e.g. the best_settings.json written by parameter_sweep."""
+        path, _ = QFileDialog.getOpenFileName(self, "Load Tracking Settings", "", "Settings (*.json)")
+        if not path:
+            return
+        self.camera_manager.load_tracking_settings(path)
+        fields = (("threshold", self.threshold_input), ("square_size", self.square_size_input),
+                  ("erode", self.erode_input), ("dilate", self.dilate_input), ("max_runway", self.max_runway_input),
+                  ("gain", self.gain_input), ("posture_every_n", self.posture_every_n_input),
+                  ("min_blob_area", self.min_blob_area_input))
+        for key, field in fields:
+            # blocked like the calibration fields, so the text is not written back into the settings
+            field.blockSignals(True)
+            field.setText(str(self.tracking_tab_settings[key]))
+            field.blockSignals(False)
+        self.brightfield_checkbox.setChecked(self.tracking_tab_settings["brightfield"])
+        self.binning_input.blockSignals(True)
+        self.binning_input.setCurrentText(self.tracking_tab_settings["binning"])
+        self.binning_input.blockSignals(False)
+        # a different binning in the file loads that binning's calibration
+        self.refresh_calibration_inputs()
+
 
     def start_live(self):
         try:
             if self.camera_manager is None:
                 print("Camera Manager not initialized!")
                 return
-            print("Camera Manager exists")  # If we get here, `self.camera_manager` is not None
         except Exception as e:
             print(f"Crash when accessing CameraManager: {e}")
+        self.camera_manager.open_events()
 
         # Start Napari viewer
-        print("starting viewer")
         viewer = napari.Viewer()
+        self.viewer = viewer
+        self.mosaic_layer = None
+        self.replay_layers = None
         layer_1 = None
         layer_2 = None
 
@@ -220,25 +360,22 @@ class setup_tracking_camera_tab(QWidget):
         # initiate the acquisition in the tracking camera
         self.camera_manager.primary_core.setExposure(tracking_exposure)
         self.camera_manager.primary_core.setProperty(self.camera_manager.primary_camera, "Binning", tracking_binning)
-        print("initiating live sequence")
+        self.camera_manager.events.log("tracking_live_started", exposure=tracking_exposure, binning=tracking_binning,
+                                       fps=tracking_fps)
 
         # starts sequence acquisition, creates layer_1, passes the first image to layer_1,
         # starts timer to continue to update layer_1
         self.camera_manager.primary_core.startContinuousSequenceAcquisition()
+        self.camera_manager.tracking_stats.reset()
 
         while self.camera_manager.primary_core.getRemainingImageCount() == 0:
             time.sleep(0.01)  # Small delay to allow frames to arrive
 
-        if self.camera_manager.primary_core.getRemainingImageCount() > 0:  # Ensure there's a new frame
-            # this generates a tuple where the first element the next frame in
-            # the circular buffer, removing it and allowing is to work with it
-            while self.camera_manager.primary_core.getRemainingImageCount() > 1:
-                self.camera_manager.primary_core.popNextImage()
-
-        img_1 = self.camera_manager.primary_core.popNextImage()
+        # take the newest frame out of the circular buffer, counting the older ones as dropped
+        img_1, _ = pop_frames(self.camera_manager.primary_core, self.camera_manager.tracking_stats, "latest")[-1]
 
         if img_1 is None or img_1.size == 0:
-            print("Error: No tracking image received.")
+            self.camera_manager.events.log("tracking_empty_frame", level="error")
             return  # Exit to prevent passing None to Napari
 
 
@@ -246,10 +383,8 @@ class setup_tracking_camera_tab(QWidget):
         # we need to reshape it to a 2D array that can be "seen" as an image
         img_1 = img_1.reshape((self.camera_manager.primary_core.getImageHeight(),
                                self.camera_manager.primary_core.getImageWidth()))
-        print("img_1 reshaped")
         # Normalize before passing to Napari
         img_1 = normalize_to_8bit(img_1)
-        print("img_1 normalized")
         # Apply translation to separate images
         if  layer_1 is None:
             layer_1 = viewer.add_image(img_1, name="Tracking Camera", colormap="gray", translate=(0, 0))
@@ -265,11 +400,22 @@ class setup_tracking_camera_tab(QWidget):
         translate_x = img_1.shape[0] + 50
         viewer.camera.center = (img_1.shape[1] // 2, img_1.shape[0] // 2 + translate_x // 2)  # Center on both images
         viewer.camera.zoom = 0.5  # Zoom out to fit both images
-        print("viewer layout setup")
+
+        # the runway mosaic is filled in the background while tracking
+        self.camera_manager.mosaic = RunwayMosaic(um_per_pixel=self.tracking_tab_settings["mosaic_um_per_pixel"],
+                                                  every_n=self.tracking_tab_settings["mosaic_every_n"])
+        # the replay buffer is allocated once for the frame size of this session
+        self.camera_manager.replay = ReplayBuffer(self.tracking_tab_settings["replay_frames"], img_1.shape)
+        self.camera_manager.events.log("replay_buffer", frames=self.camera_manager.replay.capacity,
+                                       megabytes=round(self.camera_manager.replay.nbytes() / 1e6, 1))
+        self.camera_manager.open_publisher(img_1.shape, img_1.dtype)
 
         self.camera_manager.last_tracking_frame_time = time.time()# collect time when first frame is taken
         self.camera_manager.tracking_timer = QTimer()
-        self.camera_manager.tracking_timer.timeout.connect(partial(tracking_start_live, self.camera_manager, layer_1))
+        # the detected worm is drawn above layer_1 rather than into the binary frame
+        overlay = TrackingOverlay(viewer, translate=(0, 0))
+        self.camera_manager.tracking_timer.timeout.connect(partial(tracking_start_live, self.camera_manager, layer_1,
+                                                                   overlay))
         self.camera_manager.tracking_timer.start(int(tracking_interval_ms))
 
         ### --- repeat these same steps for recording camera if there is one --- ###
@@ -283,35 +429,31 @@ class setup_tracking_camera_tab(QWidget):
             # initiate the acquisition in the tracking camera
             self.camera_manager.secondary_core.setExposure(recording_exposure)
             self.camera_manager.secondary_core.setProperty(self.camera_manager.secondary_camera, "Binning", recording_binning)
-            print("initiating live sequence")
+            self.camera_manager.events.log("recording_live_started", exposure=recording_exposure,
+                                           binning=recording_binning, fps=recording_fps)
 
             # starts sequence acquisition, creates layer_1, passes the first image to layer_1,
             # starts timer to continue to update layer_1
             self.camera_manager.secondary_core.startContinuousSequenceAcquisition()
+            self.camera_manager.recording_stats.reset()
 
             while self.camera_manager.secondary_core.getRemainingImageCount() == 0:
                 time.sleep(0.01)  # Small delay to allow frames to arrive
 
-            if self.camera_manager.secondary_core.getRemainingImageCount() > 0:  # Ensure there's a new frame
-                # this generates a tuple where the first element the next frame in
-                # the circular buffer, removing it and allowing is to work with it
-                while self.camera_manager.secondary_core.getRemainingImageCount() > 1:
-                    self.camera_manager.secondary_core.popNextImage()
-
-            img_2 = self.camera_manager.secondary_core.popNextImage()
+            # take the newest frame out of the circular buffer, counting the older ones as dropped
+            img_2, _ = pop_frames(self.camera_manager.secondary_core, self.camera_manager.recording_stats,
+                                  "latest")[-1]
 
             if img_2 is None or img_2.size == 0:
-                print("Error: No recording image received.")
+                self.camera_manager.events.log("recording_empty_frame", level="error")
                 return  # Exit to prevent passing None to Napari
 
             # since MM produces the image in the form of a fattened array (1D),
             # we need to reshape it to a 2D array that can be "seen" as an image
             img_2 = img_2.reshape((self.camera_manager.secondary_core.getImageHeight(),
                                    self.camera_manager.secondary_core.getImageWidth()))
-            print("img_1 reshaped")
             # Normalize before passing to Napari
             img_2 = normalize_to_8bit(img_2)
-            print("img_1 normalized")
             # Apply translation to separate images
             if layer_2 is None:
                 layer_2 = viewer.add_image(img_2, name="Tracking Camera", colormap="gray", translate=(0, translate_x))
@@ -333,7 +475,7 @@ class setup_tracking_camera_tab(QWidget):
         # this function is nested inside the start_live method because it was the only day I could make it work as an
         # event, which is what happens when napari window closes.
         def on_close(event):
-            print("Napari viewer closed. Stopping sequence acquisition.")
+            self.camera_manager.events.log("live_stopped")
             self.camera_manager.primary_core.stopSequenceAcquisition()
             self.camera_manager.tracking_timer.stop()
 
@@ -341,6 +483,23 @@ class setup_tracking_camera_tab(QWidget):
                 self.camera_manager.secondary_core.stopSequenceAcquisition()
                 self.camera_manager.recording_timer.stop()
 
+            self.camera_manager.close_session_files()
+            self.camera_manager.close_publisher()
+            # the focus thread moves Z, so it stops with the live and is turned on again from its checkbox
+            self.autofocus_checkbox.setChecked(False)
+            if self.camera_manager.mda_recorder is not None:
+                self.camera_manager.mda_recorder.stop()
+                self.camera_manager.mda_recorder = None
+            if self.camera_manager.mosaic is not None:
+                self.camera_manager.mosaic.stop()
+                if self.camera_manager.mosaic.version > 0:
+                    self.camera_manager.mosaic.export(
+                        os.path.join(self.camera_manager.get_session_dir(), "runway_mosaic.png"))
+                self.camera_manager.mosaic = None
+            self.viewer = None
+            self.replay_layers = None
+            # writes what is still queued and stops the writer thread
+            self.camera_manager.events.close()
             print("Live tracking stopped.")
 
         viewer.window._qt_window.closeEvent = lambda event: on_close(event)
@@ -348,6 +507,117 @@ class setup_tracking_camera_tab(QWidget):
         # get going in napari
         viewer.show()
 
+    def update_frame_stats(self):
+        """Shows how many frames each camera processed, displayed and dropped."""
+        if self.viewer is None:
+            return
+        text = f"Tracking: {self.camera_manager.tracking_stats}"
+        if self.camera_manager.tracking_stats.undersampled():
+            text += " - UNDERSAMPLED"
+        if self.camera_manager.secondary_core:
+            text += f"\nRecording: {self.camera_manager.recording_stats}"
+            if self.camera_manager.recording_stats.undersampled():
+                text += " - UNDERSAMPLED"
+        text += f"\nStage: {self.camera_manager.stage}"
+        self.frame_stats_label.setText(text)
+
+    def show_mosaic(self):
+        """Adds the runway mosaic to the live viewer, or refreshes it if it is already shown."""
+        if self.viewer is None or self.camera_manager.mosaic is None:
+            print("Start live before showing the mosaic.")
+            return
+        self.mosaic_layer = self.camera_manager.mosaic.show(self.viewer, self.mosaic_layer)
+
+    def show_replay(self):
+        """Adds the last frames of the tracking camera to the live viewer as a scrubbable stack."""
+        if self.viewer is None or self.camera_manager.replay is None:
+            print("Start live before showing the replay.")
+            return
+        self.replay_layers = self.camera_manager.replay.show(self.viewer, self.replay_layers)
+
+    def dump_replay(self):
+        """Saves the replay buffer to the session folder."""
+        if self.camera_manager.replay is None or self.camera_manager.replay.count == 0:
+            print("Replay buffer is empty.")
+            return
+        self.camera_manager.replay.dump(
+            os.path.join(self.camera_manager.get_session_dir(), f"replay_{time.strftime('%H%M%S')}.npz"))
+
+    def start_profile(self):
+        """Samples the call stacks of all threads for 10 s and saves the profile to the session folder."""
+        path = os.path.join(self.camera_manager.get_session_dir(), f"profile_{time.strftime('%H%M%S')}.collapsed")
+        if self.profiler.start(path, self.tracking_tab_settings):
+            print("Profiling for 10 s...")
+
+    def toggle_mda_recording(self):
+        """
+        Starts a hardware-sequenced recording of the recording camera (or of the tracking camera
+        when there is only one), or cancels the one in progress.
+        """
+        recorder = self.camera_manager.mda_recorder
+        if recorder is not None and recorder.running():
+            recorder.stop()
+            return
+        if self.camera_manager.secondary_core:
+            core = self.camera_manager.secondary_core
+            settings = self.recording_tab_settings
+            # the MDA engine takes over the camera, so its live view stops
+            if core.isSequenceRunning():
+                core.stopSequenceAcquisition()
+                self.camera_manager.recording_timer.stop()
+        else:
+            core = self.camera_manager.primary_core
+            settings = self.tracking_tab_settings
+            if core.isSequenceRunning():
+                print("Close live before an MDA recording of the tracking camera.")
+                return
+        directory = os.path.join(self.camera_manager.get_session_dir(), f"mda_{time.strftime('%H%M%S')}")
+        self.camera_manager.mda_recorder = MdaRecorder(core, directory, settings["fps"],
+                                                       self.recording_tab_settings["mda_duration_s"],
+                                                       exposure=settings["exposure"])
+        self.camera_manager.mda_recorder.start()
+
+    def update_multi_worm(self):
+        """Starts or stops tracking every worm in the tracking camera."""
+        self.camera_manager.update_tracking_settings({"multi_worm": self.multi_worm_checkbox.isChecked()})
+        if self.multi_worm_checkbox.isChecked():
+            self.camera_manager.multi_tracker = MultiWormTracker(
+                max_distance=self.tracking_tab_settings["multi_worm_max_distance_um"])
+        else:
+            if self.camera_manager.multi_tracker is not None and self.camera_manager.multi_tracker.rows:
+                self.camera_manager.multi_tracker.save(
+                    os.path.join(self.camera_manager.get_session_dir(), "multi_worm_tracks.csv"))
+            self.camera_manager.multi_tracker = None
+
+    def update_publishing(self):
+        """Starts or stops publishing the live tracking frames to shared memory."""
+        self.camera_manager.update_tracking_settings({"publish_frames": self.publish_frames_checkbox.isChecked()})
+        if self.viewer is None:
+            return  # the publisher is opened when the live starts
+        if self.publish_frames_checkbox.isChecked():
+            # the normalized 8-bit frames are published, as in start_live
+            self.camera_manager.open_publisher((self.camera_manager.primary_core.getImageHeight(),
+                                                self.camera_manager.primary_core.getImageWidth()), np.uint8)
+            if self.camera_manager.publisher is None:
+                self.publish_frames_checkbox.setChecked(False)
+        else:
+            self.camera_manager.close_publisher()
+
+    def update_autofocus(self):
+        """Starts or stops the ROI sharpness focus tracking."""
+        self.camera_manager.update_tracking_settings({"autofocus": self.autofocus_checkbox.isChecked()})
+        if self.camera_manager.focus_tracker is not None:
+            self.camera_manager.focus_tracker.stop()
+            self.camera_manager.focus_tracker = None
+        if self.autofocus_checkbox.isChecked():
+            try:
+                self.camera_manager.focus_tracker = FocusTracker(self.camera_manager.primary_core,
+                                                                 every_n=self.tracking_tab_settings["af_every_n"],
+                                                                 step=self.tracking_tab_settings["af_step"])
+            except ValueError as e:
+                print(e)
+                self.autofocus_checkbox.setChecked(False)
+
     def update_tracking_state(self):
         if self.prepare_button.isChecked():
             self.camera_manager.tracking_state["prepare"] = "ON"  # Start prepare mode
@@ -355,14 +625,21 @@ class setup_tracking_camera_tab(QWidget):
             self.camera_manager.tracking_state["prepare"] = "OFF"  # Stop prepare mode
 
         if self.track_button.isChecked():
+            if self.camera_manager.tracking_state["track"] != "ON":
+                # the runway is measured from where the stage is when tracking starts
+                self.camera_manager.stage.resync()
+                self.camera_manager.stage.reset_origin()
             self.camera_manager.tracking_state["track"] = "ON"
         else:
+            if self.camera_manager.tracking_state["track"] == "ON":
+                self.camera_manager.close_session_files()
             self.camera_manager.tracking_state["track"] = "OFF"
 
         if self.record_button.isChecked():
             self.camera_manager.tracking_state["record"] = "ON"
         else:
             self.camera_manager.tracking_state["record"] = "OFF"
+            self.camera_manager.close_roi_recording()
 
 
     def prepare_tracking(self):
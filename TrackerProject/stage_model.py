@@ -0,0 +1,85 @@
+"""
+StageModel: The stage position estimated from the moves we send, instead of read every frame
+
+Logging, mosaics, ROI recording and the runway limit need the absolute stage position on every
+frame, but getXYPosition is a round trip over the serial port that takes milliseconds. Since
+every tracking move goes through move_stage, the position can be estimated by adding up the
+relative moves that were commanded. The estimate is checked against the controller at a low
+rate (every resync_s seconds): the difference is recorded as drift (missed steps, moves clipped
+by the controller, a move still in progress, or the stage being moved by hand), and the
+estimate is then replaced by the real position.
+
+The runway limit is applied to the estimate before a move is sent: moves that would take the
+stage more than max_runway microns away from where tracking started (on either axis) are cut
+at the limit.
+
+"""
+
+import time
+import numpy as np
+
+
+class StageModel:
+    def __init__(self, core, resync_s=1.0, xy_device=None):
+        self.core = core
+        self.xy_device = xy_device or core.getXYStageDevice()
+        self.resync_s = resync_s
+        self.position = np.zeros(2)
+        self.origin = np.zeros(2)
+        self.last_sync = 0.0
+        self.last_drift = np.zeros(2)
+        self.max_drift = 0.0
+        self.resyncs = 0
+        self.limited_moves = 0
+        self.resync()
+        self.reset_origin()
+
+    def resync(self):
+        """Reads the real position from the controller and records how far the estimate was off."""
+        self.last_sync = time.time()
+        if not self.xy_device:
+            return
+        # while a move is in progress the controller reports a position somewhere along the way
+        if self.core.deviceBusy(self.xy_device):
+            return
+        real = np.array(self.core.getXYPosition(self.xy_device), dtype=float)
+        if self.resyncs > 0:
+            self.last_drift = real - self.position
+            self.max_drift = max(self.max_drift, float(np.hypot(*self.last_drift)))
+        self.position = real
+        self.resyncs += 1
+
+    def get_position(self):
+        """The estimated stage position (um). Costs nothing except on the occasional resync."""
+        if time.time() - self.last_sync >= self.resync_s:
+            self.resync()
+        return float(self.position[0]), float(self.position[1])
+
+    def reset_origin(self):
+        """Makes the current position the center of the runway, e.g. when tracking starts."""
+        self.origin = self.position.copy()
+
+    def limit_move(self, dx, dy, max_runway):
+        """Returns the part of the relative move (dx, dy) that keeps the stage inside the runway."""
+        if not max_runway:
+            return dx, dy
+        target = np.clip(self.position + (dx, dy), self.origin - max_runway, self.origin + max_runway)
+        limited = target - self.position
+        if limited[0] != dx or limited[1] != dy:
+            self.limited_moves += 1
+        return float(limited[0]), float(limited[1])
+
+    def moved(self, dx, dy):
+        """Adds a relative move that was sent to the stage to the estimate."""
+        self.position += (dx, dy)
+
+    def summary(self):
+        return {"resyncs": self.resyncs,
+                "last_drift_um": self.last_drift.tolist(),
+                "max_drift_um": self.max_drift,
+                "limited_moves": self.limited_moves,
+                "distance_from_origin_um": (self.position - self.origin).tolist()}
+
+    def __str__(self):
+        return (f"drift {np.hypot(*self.last_drift):.1f} um (max {self.max_drift:.1f} um), "
+                f"{self.limited_moves} moves limited by the runway")
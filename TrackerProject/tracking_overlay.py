@@ -0,0 +1,44 @@
+"""
+TrackingOverlay: The detected worm drawn as napari layers on top of the live image
+
+The ROI square and the worm's outline are the edges of a Vectors layer, and the center is a
+Points layer, both above the tracking camera layer. Each frame only their coordinate arrays are
+replaced, which is a few dozen numbers instead of a new image texture. A Shapes layer would
+rebuild and re-triangulate its shapes on every assignment (and reset their edge width), so it
+is not used here. The binary frame shown underneath stays exactly what the tracker used. When
+no worm is found the layers are emptied.
+
+napari uses (row, column) coordinates, so the (x, y) points of a Detection are flipped.
+
+"""
+
+import numpy as np
+
+
+def _edges(points):
+    """Vectors layer data (N, 2, 2) for the closed polygon through points (N, 2): start and direction."""
+    return np.stack((points, np.roll(points, -1, axis=0) - points), axis=1)
+
+
+class TrackingOverlay:
+    def __init__(self, viewer, translate=(0, 0)):
+        self.edges = viewer.add_vectors(np.empty((0, 2, 2)), name="Tracking ROI", edge_color="yellow",
+                                        edge_width=2, vector_style="line", translate=translate)
+        self.center = viewer.add_points(np.empty((0, 2)), name="Worm Center", face_color="red",
+                                        size=10, translate=translate)
+        self.last = None
+
+    def update(self, detection):
+        if detection is self.last:
+            return
+        self.last = detection
+        if detection is None:
+            if len(self.edges.data):
+                self.edges.data = np.empty((0, 2, 2))
+                self.center.data = np.empty((0, 2))
+            return
+        x1, y1, x2, y2 = detection.roi
+        roi = np.array([[y1, x1], [y1, x2], [y2, x2], [y2, x1]], dtype=float)
+        outline = detection.contour[:, ::-1].astype(float)
+        self.edges.data = np.concatenate((_edges(roi), _edges(outline)))
+        self.center.data = np.array([[detection.center[1], detection.center[0]]], dtype=float)
@@ -0,0 +1,85 @@
+"""
+TrackingPlan: The per-frame tracking pipeline compiled from tracking_tab_settings
+
+binary_threshold and update_vectors run on every frame, but their settings only change when
+the user edits a field in the tracking tab. compile_plan turns the settings dictionary into an
+immutable TrackingPlan holding everything the per-frame code needs (threshold type, kernel,
+morphology steps, ROI size, calibration matrix, and which frames are logged, analysed and
+recorded), so the hot loop does no dictionary lookups, builds no kernels and does not branch on
+the settings. Settings that only the live loop uses have defaults, so plans can also be compiled
+from the shorter settings dictionaries of offline tools.
+
+CameraManager.update_tracking_settings rebuilds the plan whenever a setting changes and swaps
+it in with a single assignment, so the tracking loop always sees either the old plan or the
+new one, never a mix of both.
+
+"""
+
+from typing import NamedTuple
+import numpy as np
+import cv2
+
+
+class TrackingPlan(NamedTuple):
+    threshold: int
+    threshold_type: int
+    kernel: np.ndarray
+    morphology: tuple        # ((cv2.MORPH_*, iterations), ...) applied in order
+    square_size: int
+    calibration: np.ndarray  # 2x2 matrix from pixels to stage microns, scale included
+    gain: float
+    max_runway: float        # um the stage may travel from where tracking started, 0 for no limit
+    stage_motion: bool       # send the computed moves to the stage, off until closed-loop motion is enabled
+    save_stage_positions: bool
+    posture_every_n: int     # 0 for no posture extraction
+    posture_points: int
+    min_blob_area: int       # pixels, for multi-worm tracking
+    frame_policy: str        # see frame_source.FRAME_POLICIES
+    every_n_frames: int
+
+
+def compile_plan(tracking_tab_settings):
+    # define the type of binary threshold based on the type of imaging
+    if tracking_tab_settings["brightfield"]:
+        threshold_type = cv2.THRESH_BINARY_INV
+    else:
+        threshold_type = cv2.THRESH_BINARY
+
+    # create a kernel (small matrix) that will be used to scan image and erode or dilate white objects
+    # bigger kernels allows the transformation to be more dramatic
+    kernel = np.ones((3, 3), np.uint8)
+    kernel.flags.writeable = False
+
+    # "erode n times then dilate m times" is an opening for the iterations they have in common,
+    # preceded by the extra erosions or followed by the extra dilations
+    erode_iter = max(0, tracking_tab_settings["erode"])
+    dilate_iter = max(0, tracking_tab_settings["dilate"])
+    common = min(erode_iter, dilate_iter)
+    morphology = []
+    if erode_iter > common:
+        morphology.append((cv2.MORPH_ERODE, erode_iter - common))
+    if common > 0:
+        morphology.append((cv2.MORPH_OPEN, common))
+    if dilate_iter > common:
+        morphology.append((cv2.MORPH_DILATE, dilate_iter - common))
+
+    scale = tracking_tab_settings["scale"]
+    calibration = np.array([[tracking_tab_settings["xx"], tracking_tab_settings["xy"]],
+                            [tracking_tab_settings["yx"], tracking_tab_settings["yy"]]], dtype=np.float64) * scale
+    calibration.flags.writeable = False
+
+    return TrackingPlan(threshold=tracking_tab_settings["threshold"],
+                        threshold_type=threshold_type,
+                        kernel=kernel,
+                        morphology=tuple(morphology),
+                        square_size=tracking_tab_settings["square_size"],
+                        calibration=calibration,
+                        gain=tracking_tab_settings["gain"],
+                        max_runway=tracking_tab_settings.get("max_runway", 0),
+                        stage_motion=tracking_tab_settings.get("stage_motion", False),
+                        save_stage_positions=tracking_tab_settings.get("Save_stage_positions", False),
+                        posture_every_n=tracking_tab_settings.get("posture_every_n", 0),
+                        posture_points=tracking_tab_settings.get("posture_points", 50),
+                        min_blob_area=tracking_tab_settings.get("min_blob_area", 50),
+                        frame_policy=tracking_tab_settings.get("frame_policy", "latest"),
+                        every_n_frames=tracking_tab_settings.get("every_n_frames", 2))
@@ -0,0 +1,167 @@
+"""
+trajectory_analysis: Offline reconstruction of the worm's path and locomotion metrics
+
+During tracking (with "Save Stage Positions?" checked) every frame is logged as one row of a
+session CSV file: the stage XY position, the worm center found by binary_threshold, and the
+size of the frame. The worm's absolute position is the stage position plus the worm's offset
+from the center of the frame, converted to microns with the same pixel_to_stage conversion
+that update_vectors uses, so the numbers computed online and offline match.
+
+Key Features:
+- SessionLogWriter appends one row per tracked frame to the session CSV file.
+- iter_session_chunks reads a session file in fixed-size chunks so memory stays bounded.
+- iter_trajectory computes position, speed, heading, reversals and path curvature with
+  whole-array NumPy operations, carrying two samples across chunk boundaries.
+- analyze_session writes the metrics to a CSV file and returns a summary of the session.
+
+"""
+
+import itertools
+import numpy as np
+from binary_tracker import pixel_to_stage
+from tracking_plan import compile_plan
+
+
+SESSION_COLUMNS = ("time", "stage_x", "stage_y", "pos_x", "pos_y", "img_width", "img_height")
+TRAJECTORY_COLUMNS = ("time", "x", "y", "speed", "heading", "reversal", "curvature")
+# microsecond timestamps and nanometer positions, like the session log they are computed from
+TRAJECTORY_FORMATS = ("%.6f", "%.3f", "%.3f", "%.3f", "%.6f", "%d", "%.6g")
+
+
+class SessionLogWriter:
+    """
+    Appends one row per tracked frame to a session CSV file. Rows are buffered by the file
+    object so the tracking loop does not wait on the disk for every frame.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, "w", buffering=1 << 16)
+        self.file.write(",".join(SESSION_COLUMNS) + "\n")
+        self.rows = 0
+
+    def write_row(self, timestamp, stage_xy, position, img_width, img_height):
+        # when the worm is lost we still log the stage position, with NaN as the worm position
+        if position is None:
+            position = (np.nan, np.nan)
+        self.file.write(f"{timestamp:.6f},{stage_xy[0]:.3f},{stage_xy[1]:.3f},"
+                        f"{position[0]},{position[1]},{img_width},{img_height}\n")
+        self.rows += 1
+
+    def close(self):
+        if not self.file.closed:
+            self.file.close()
+
+
+def iter_session_chunks(path, chunk_size=100000):
+    """Yields the session file as float64 arrays of shape (<= chunk_size, len(SESSION_COLUMNS))."""
+    with open(path) as f:
+        header = f.readline().strip().split(",")
+        if tuple(header) != SESSION_COLUMNS:
+            raise ValueError(f"Unexpected session log header in {path}: {header}")
+        while True:
+            lines = list(itertools.islice(f, chunk_size))
+            if not lines:
+                return
+            yield np.loadtxt(lines, delimiter=",", ndmin=2, dtype=np.float64)
+
+
+"""
+Converts logged rows into absolute worm positions in stage microns. The offset is measured
+from the center of the frame exactly as in update_vectors, so the position returned is the
+stage position at which the worm would sit in the center of the frame.
+"""
+def worm_positions(plan, rows):
+    offset_x = rows[:, 5] / 2 - rows[:, 3]
+    offset_y = rows[:, 6] / 2 - rows[:, 4]
+    stage_dx, stage_dy = pixel_to_stage(plan, offset_x, offset_y)
+    return rows[:, 1] + stage_dx, rows[:, 2] + stage_dy
+
+
+def iter_trajectory(path, tracking_tab_settings, chunk_size=100000,
+                    reversal_angle=np.deg2rad(135), min_step=0.5):
+    """
+    Yields one array per chunk with the columns in TRAJECTORY_COLUMNS.
+
+    speed is in um/s and heading in radians, both computed from the step that ends on each
+    sample. A reversal is a turn sharper than reversal_angle between consecutive steps, and
+    curvature is the turning angle divided by the mean length of those steps (1/um). Steps
+    shorter than min_step (um) have no defined heading, which keeps a resting worm from
+    producing spurious reversals.
+    """
+    plan = compile_plan(tracking_tab_settings)
+    # the last two samples of the previous chunk, so differences are continuous across chunks
+    carry = np.full((2, 3), np.nan)
+
+    for rows in iter_session_chunks(path, chunk_size):
+        x, y = worm_positions(plan, rows)
+        samples = np.concatenate((carry, np.column_stack((rows[:, 0], x, y))))
+        carry = samples[-2:]
+
+        # steps between consecutive samples: index i is the step ending on samples[i + 1]
+        dt = np.diff(samples[:, 0])
+        step = np.diff(samples[:, 1:], axis=0)
+        step_length = np.hypot(step[:, 0], step[:, 1])
+        with np.errstate(invalid="ignore", divide="ignore"):
+            speed = step_length / dt
+        heading = np.arctan2(step[:, 1], step[:, 0])
+        heading[~(step_length >= min_step)] = np.nan
+
+        # turning angle between consecutive steps, wrapped to [-pi, pi)
+        turn = (np.diff(heading) + np.pi) % (2 * np.pi) - np.pi
+        with np.errstate(invalid="ignore"):
+            reversal = np.abs(turn) > reversal_angle
+            curvature = turn / ((step_length[1:] + step_length[:-1]) / 2)
+
+        n = len(rows)
+        out = np.empty((n, len(TRAJECTORY_COLUMNS)))
+        out[:, 0] = rows[:, 0]
+        out[:, 1] = x
+        out[:, 2] = y
+        out[:, 3] = speed[-n:]
+        out[:, 4] = heading[-n:]
+        out[:, 5] = reversal[-n:]
+        out[:, 6] = curvature[-n:]
+        yield out
+
+
+def analyze_session(path, tracking_tab_settings, out_path=None, chunk_size=100000):
+    """
+    Runs iter_trajectory over a whole session, optionally writing the metrics to out_path,
+    and returns a summary dictionary. Only running sums are kept in memory.
+    """
+    out_file = None
+    if out_path is not None:
+        out_file = open(out_path, "w")
+        out_file.write(",".join(TRAJECTORY_COLUMNS) + "\n")
+
+    summary = {"frames": 0, "tracked_frames": 0, "duration_s": 0.0,
+               "path_length_um": 0.0, "reversals": 0}
+    start_time = None
+    last = None
+    try:
+        for chunk in iter_trajectory(path, tracking_tab_settings, chunk_size):
+            if start_time is None:
+                start_time = chunk[0, 0]
+            summary["frames"] += len(chunk)
+            summary["tracked_frames"] += int(np.count_nonzero(~np.isnan(chunk[:, 1])))
+            summary["reversals"] += int(np.count_nonzero(chunk[:, 5]))
+
+            # include the step from the last sample of the previous chunk
+            positions = chunk[:, 1:3]
+            if last is not None:
+                positions = np.vstack((last, positions))
+            summary["path_length_um"] += float(np.nansum(np.hypot(*np.diff(positions, axis=0).T)))
+            last = chunk[-1, 1:3]
+            summary["duration_s"] = float(chunk[-1, 0] - start_time)
+
+            if out_file is not None:
+                np.savetxt(out_file, chunk, delimiter=",", fmt=TRAJECTORY_FORMATS)
+    finally:
+        if out_file is not None:
+            out_file.close()
+
+    if summary["duration_s"] > 0:
+        summary["mean_speed_um_s"] = summary["path_length_um"] / summary["duration_s"]
+    else:
+        summary["mean_speed_um_s"] = 0.0
+    return summary